@@ -0,0 +1,290 @@
+#!/usr/bin/python
+# End-to-end relay benchmark. Runs ircbot.Manager and websocket-server's
+# Manager in one process against a fake Redis (pub/sub only) and a fake
+# IRCd, with simulated WebSocket clients, publishes messages at a fixed
+# rate and reports throughput and Redis -> IRC / Redis -> WebSocket latency
+# as JSON. The IRC flood limit is raised to --irc-rate so the relay, not
+# the token bucket, is what's measured.
+#
+#   python bench/e2e.py --rate 2000 --duration 10 --output e2e.json
+from __future__ import print_function
+
+import argparse
+import imp
+import json
+import os
+import re
+import shutil
+import socket
+import struct
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+from twisted.internet import protocol, reactor, task
+from twisted.protocols.basic import LineReceiver
+
+import tx_redis
+
+marker_re = re.compile(r"bench:(\d+)")
+
+
+def encode(value):
+    if isinstance(value, (int, long)):
+        return ':{}\r\n'.format(value)
+    if isinstance(value, list):
+        return '*{}\r\n'.format(len(value)) + ''.join(encode(v) for v in value)
+    return '${}\r\n{}\r\n'.format(len(value), value)
+
+
+class FakeRedis(protocol.Protocol):
+    def connectionMade(self):
+        self.reader = tx_redis.Reader()
+        self.channels = set()
+        self.factory.clients.add(self)
+
+    def connectionLost(self, reason):
+        self.factory.clients.discard(self)
+
+    def dataReceived(self, data):
+        self.reader.feed(data)
+        command = self.reader.gets()
+        while command is not False:
+            self.command(command[0].upper(), command[1:])
+            command = self.reader.gets()
+
+    def command(self, name, args):
+        if name == 'SUBSCRIBE':
+            for channel in args:
+                self.channels.add(channel)
+                self.transport.write(encode(['subscribe', channel, len(self.channels)]))
+        elif name == 'UNSUBSCRIBE':
+            for channel in args:
+                self.channels.discard(channel)
+                self.transport.write(encode(['unsubscribe', channel, len(self.channels)]))
+        elif name == 'PUBLISH':
+            self.transport.write(encode(self.factory.publish(*args)))
+        else:
+            self.transport.write('-ERR unsupported command\r\n')
+
+
+class FakeRedisFactory(protocol.ServerFactory):
+    protocol = FakeRedis
+
+    def __init__(self):
+        self.clients = set()
+
+    def publish(self, channel, data):
+        message = encode(['message', channel, data])
+        count = 0
+        for client in self.clients:
+            if channel in client.channels:
+                client.transport.write(message)
+                count += 1
+        return count
+
+
+class FakeIRCd(LineReceiver):
+    delimiter = '\r\n'
+    nick = 'relay'
+
+    def lineReceived(self, line):
+        command, _, rest = line.partition(' ')
+        if command == 'NICK':
+            self.nick = rest.lstrip(':')
+        elif command == 'USER':
+            self.sendLine(':fake 001 {} :Welcome'.format(self.nick))
+            self.sendLine(':fake 376 {} :End of MOTD'.format(self.nick))
+        elif command == 'JOIN':
+            for channel in rest.split(' ')[0].split(','):
+                self.sendLine(':{0}!relay@fake JOIN {1}'.format(self.nick, channel))
+                self.sendLine(':fake 366 {} {} :End of NAMES'.format(self.nick, channel))
+        elif command == 'PRIVMSG':
+            self.factory.sink.received(rest)
+
+
+class FakeIRCdFactory(protocol.ServerFactory):
+    protocol = FakeIRCd
+
+    def __init__(self, sink):
+        self.sink = sink
+
+
+class WebSocketClient(protocol.Protocol):
+    # RFC 6455 client, enough to receive unmasked text frames
+    def __init__(self, path, sink):
+        self.path = path
+        self.sink = sink
+        self.buf = ''
+        self.open = False
+
+    def connectionMade(self):
+        self.transport.write("GET {} HTTP/1.1\r\nHost: localhost\r\nUpgrade: websocket\r\n"
+                             "Connection: Upgrade\r\nSec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\n"
+                             "Sec-WebSocket-Version: 13\r\n\r\n".format(self.path))
+
+    def dataReceived(self, data):
+        self.buf += data
+        if not self.open:
+            if '\r\n\r\n' not in self.buf:
+                return
+            self.buf = self.buf.split('\r\n\r\n', 1)[1]
+            self.open = True
+        while len(self.buf) >= 2:
+            length, offset = ord(self.buf[1]) & 0x7f, 2
+            if length == 126:
+                length, offset = struct.unpack('>H', self.buf[2:4])[0], 4
+            elif length == 127:
+                length, offset = struct.unpack('>Q', self.buf[2:10])[0], 10
+            if len(self.buf) < offset + length:
+                return
+            self.sink.received(self.buf[offset:offset + length])
+            self.buf = self.buf[offset + length:]
+
+
+class Sink(object):
+    # Latencies of every marked message seen by one kind of receiver.
+    def __init__(self, sent):
+        self.sent = sent
+        self.latencies = []
+        self.last = None
+
+    def received(self, data):
+        now = time.time()
+        for seq in marker_re.findall(data):
+            self.latencies.append(now - self.sent[int(seq)])
+        self.last = now
+
+    def report(self, first, expected):
+        lat = sorted(self.latencies)
+        def pct(p):
+            return lat[min(len(lat) - 1, int(len(lat) * p))] * 1e3 if lat else None
+        elapsed = (self.last - first) if self.last else None
+        return {
+            'received': len(lat),
+            'expected': expected,
+            'messages_per_sec': len(lat) / elapsed if elapsed else 0.0,
+            'latency_ms': {'p50': pct(0.5), 'p99': pct(0.99), 'max': lat[-1] * 1e3 if lat else None},
+        }
+
+
+def free_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def write_config(path, args, redis_port, irc_port, web_port):
+    channels = ['bench{}'.format(i) for i in xrange(args.channels)]
+    config = {
+        'servers': {'bench': {
+            'host': '127.0.0.1', 'port': irc_port, 'nickname': 'relay',
+            'flood_rate': args.irc_rate, 'flood_burst': args.irc_rate,
+            'channel_map': dict(('#' + c, c) for c in channels),
+        }},
+        'web': {
+            'channel_map': dict((c, 'mcrelay:' + c) for c in channels),
+            'history_size': 100, 'history_mode': 'count',
+            'host': 'tcp:{}:interface=127.0.0.1'.format(web_port),
+        },
+        'redis_host': '127.0.0.1',
+        'redis_port': redis_port,
+    }
+    with open(path, 'w') as f:
+        json.dump(config, f)  # JSON is valid YAML
+    return channels
+
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end relay benchmark.')
+    parser.add_argument('--rate', type=float, default=1000, help='messages published per second')
+    parser.add_argument('--duration', type=float, default=5, help='seconds to publish for')
+    parser.add_argument('--channels', type=int, default=3)
+    parser.add_argument('--clients', type=int, default=100, help='WebSocket clients per channel')
+    parser.add_argument('--size', type=int, default=100, help='message size in bytes')
+    parser.add_argument('--irc-rate', type=float, default=1e6, help='IRC flood limit, lines per second')
+    parser.add_argument('--drain', type=float, default=2, help='seconds to wait for stragglers')
+    parser.add_argument('--output', help='write the JSON report here instead of stdout')
+    args = parser.parse_args()
+    if args.output:
+        args.output = os.path.abspath(args.output)
+
+    sent = {}
+    irc_sink, web_sink = Sink(sent), Sink(sent)
+    redis = FakeRedisFactory()
+    redis_port = reactor.listenTCP(0, redis, interface='127.0.0.1').getHost().port
+    irc_port = reactor.listenTCP(0, FakeIRCdFactory(irc_sink), interface='127.0.0.1').getHost().port
+    web_port = free_port()
+
+    workdir = tempfile.mkdtemp(prefix='mcrelay-bench-')
+    os.chdir(workdir)
+    channels = write_config('config.yml', args, redis_port, irc_port, web_port)
+
+    import ircbot
+    ws_server = imp.load_source('websocket_server', os.path.join(ROOT, 'websocket-server.py'))
+    ws_server.CONFIG = ws_server.load_config()
+    ircbot.Manager()
+    ws_server.Manager().setup()
+
+    state = {'seq': 0, 'first': None}
+    padding = 'x' * max(0, args.size - 20)
+
+    def publish():
+        if state['first'] is None:
+            state['first'] = time.time()
+        due = int((time.time() - state['first']) * args.rate) + 1
+        while state['seq'] < due:
+            seq = state['seq']
+            sent[seq] = time.time()
+            redis.publish('mcrelay:' + channels[seq % len(channels)], 'bench:{} {}'.format(seq, padding))
+            state['seq'] += 1
+
+    def start():
+        for channel in channels:
+            for i in xrange(args.clients):
+                factory = protocol.ClientFactory()
+                factory.protocol = lambda c=channel: WebSocketClient('/chat/{}/socket'.format(c), web_sink)
+                reactor.connectTCP('127.0.0.1', web_port, factory)
+        reactor.callLater(1.0, run)
+
+    def run():
+        loop = task.LoopingCall(publish)
+        loop.start(0.01)
+        reactor.callLater(args.duration, stop, loop)
+
+    def stop(loop):
+        loop.stop()
+        reactor.callLater(args.drain, finish)
+
+    def finish():
+        total = state['seq']
+        report = {
+            'config': vars(args),
+            'published': total,
+            'publish_rate': total / args.duration,
+            'irc': irc_sink.report(state['first'], total),
+            'websocket': web_sink.report(state['first'], total * args.clients),
+        }
+        out = json.dumps(report, indent=2, sort_keys=True)
+        if args.output:
+            with open(args.output, 'w') as f:
+                f.write(out + '\n')
+        else:
+            print(out)
+        reactor.stop()
+
+    # wait for the bots to sign on and join before connecting clients
+    reactor.callLater(1.0, start)
+    try:
+        reactor.run()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+#!/usr/bin/python
+# Measures WebFactory.relay fan-out latency with 1k, 10k and 50k clients on
+# one channel, against the old per-client send() path (txws re-encoding and
+# re-framing the message for every client). Client sockets are replaced by
+# a sink that only counts bytes, so this measures the relay's own cost.
+#
+#   python bench/fanout.py [payload bytes] [messages]
+from __future__ import print_function
+
+import imp
+import os
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+import txws
+
+ws_server = imp.load_source('websocket_server', os.path.join(ROOT, 'websocket-server.py'))
+
+CHANNEL = 'mcrelay:survival'
+
+
+class Sink(object):
+    written = 0
+
+    def write(self, data):
+        self.written += len(data)
+
+
+def make_factory(count):
+    factory = ws_server.WebFactory(None, {'survival': CHANNEL})
+    for i in xrange(count):
+        p = ws_server.WebProtocol(factory)
+        wrapper = txws.WebSocketProtocol(None, p)
+        wrapper.state = txws.FRAMES
+        wrapper.flavor = txws.RFC6455
+        wrapper.transport = Sink()
+        p.transport = wrapper
+        factory.clients[CHANNEL].add(p)
+    return factory
+
+
+def old_relay(factory, channel, data):
+    for p in factory.clients[channel]:
+        p.transport.write(data)
+
+
+def measure(relay, factory, data, messages):
+    times = []
+    for i in xrange(messages):
+        start = time.time()
+        relay(factory, CHANNEL, data)
+        times.append(time.time() - start)
+    times.sort()
+    return times[len(times) // 2], times[-1]
+
+
+def main():
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    messages = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    data = u'\u00a7a<someone>\u00a7f ' + u'x' * size
+    print("{:>7} {:>14} {:>14} {:>8}".format("clients", "send() p50 ms", "relay() p50 ms", "speedup"))
+    for count in (1000, 10000, 50000):
+        factory = make_factory(count)
+        old, _ = measure(old_relay, factory, data, messages)
+        new, _ = measure(ws_server.WebFactory.relay, factory, data, messages)
+        print("{:>7} {:>14.2f} {:>14.2f} {:>7.1f}x".format(count, old * 1000, new * 1000, old / new))
+
+
+if __name__ == '__main__':
+    main()
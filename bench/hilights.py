@@ -0,0 +1,85 @@
+#!/usr/bin/python
+# Times IRCBot.cancel_hilights (membership store, one pass) against the old regex
+# substitution with an InsensitiveDict lookup per token, on a channel with
+# a lot of users.
+#
+#   python bench/hilights.py [users] [messages]
+from __future__ import print_function
+
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from twisted.python.util import InsensitiveDict
+
+import ircbot
+
+CHANNEL = '#RedditMC-S'
+WORDS = u"the a creeper blew up my house again lol anyone got iron diamonds".split()
+
+old_re = re.compile(ur"(?:(?<=\u00a7[0-9a-flmnor])|(?<!\u00a7)\b).+?\b")
+
+
+def old_cancel_hilights(members, text):
+    def hl(match):
+        s = match.group(0)
+        if len(s) >= 2 and s in members:
+            return s[:-1] + '*' + s[-1]
+        else:
+            return s
+    return old_re.sub(hl, text)
+
+
+def make_bot(nicks):
+    irc = ircbot.IRC()
+    irc.channel_map = {CHANNEL: 'mcrelay:survival'}
+    factory = ircbot.IRCBotFactory(irc, irc.nickname, [CHANNEL])
+    bot = ircbot.IRCBot(factory, irc)
+    for nick in nicks:
+        bot.members.join(CHANNEL, nick)
+    return bot
+
+
+def make_messages(nicks, count):
+    rnd = random.Random(1)
+    messages = []
+    for i in xrange(count):
+        words = [rnd.choice(WORDS) for _ in xrange(rnd.randint(3, 40))]
+        if rnd.random() < 0.3:
+            words.insert(rnd.randint(0, len(words)), unicode(rnd.choice(nicks)))
+        messages.append(u"\u00a77<\u00a7f{}\u00a77> {}".format(rnd.choice(nicks), u' '.join(words)))
+    return messages
+
+
+def main():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 600
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+    nicks = ['Player{}_{}'.format(i, random.Random(i).randint(0, 999)) for i in xrange(users)]
+    messages = make_messages(nicks, count)
+
+    members = InsensitiveDict()
+    for nick in nicks:
+        members[nick] = True
+    start = time.time()
+    for m in messages:
+        old_cancel_hilights(members, m)
+    old = time.time() - start
+
+    bot = make_bot(nicks)
+    start = time.time()
+    for m in messages:
+        bot.cancel_hilights(CHANNEL, m)
+    new = time.time() - start
+
+    print("{} users, {} messages".format(users, count))
+    print("regex + InsensitiveDict: {:8.1f} us/msg".format(old / count * 1e6))
+    print("membership store:        {:8.1f} us/msg".format(new / count * 1e6))
+    print("speedup: {:.1f}x".format(old / new))
+
+
+if __name__ == '__main__':
+    main()
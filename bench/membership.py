@@ -0,0 +1,119 @@
+#!/usr/bin/python
+# Memory used by IRCBot's membership tracking on a large network: the
+# MembershipStore against the old layout (InsensitiveDicts of IRCUser and
+# IRCUserInChannel objects with instance dicts), plus the time to apply a
+# burst of joins, renames and quits.
+#
+#   python bench/membership.py [users] [channels]
+from __future__ import print_function
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from twisted.python.util import InsensitiveDict
+
+import ircbot
+
+
+class OldUser(object):
+    username = ""
+    hostname = ""
+    oper = False
+    away = False
+
+    def __init__(self, parent, nick):
+        self.parent = parent
+        self.nick = nick
+
+
+class OldUserInChannel(object):
+    status = ""
+
+    def __init__(self, user, channel):
+        self.user = user
+        self.channel = channel
+
+
+def deep_size(root):
+    seen = set()
+    stack = [root]
+    total = 0
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or obj is None or isinstance(obj, (bool, int, type)):
+            continue
+        seen.add(id(obj))
+        total += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            stack.extend(obj)
+        elif isinstance(obj, InsensitiveDict):
+            stack.append(obj.data)
+        elif hasattr(obj, '__dict__'):
+            stack.append(obj.__dict__)
+        elif hasattr(obj, '__slots__'):
+            stack.extend(getattr(obj, k, None) for k in obj.__slots__)
+    return total
+
+
+def make_events(users, channels):
+    rnd = random.Random(1)
+    names = ['#chan{}'.format(i) for i in xrange(channels)]
+    events = []
+    for i in xrange(users):
+        for channel in rnd.sample(names, rnd.randint(1, 3)):
+            events.append((channel, 'Player{}_{}'.format(i, rnd.randint(0, 999))))
+    return events
+
+
+def old_layout(events):
+    users, chans = InsensitiveDict(), InsensitiveDict()
+    for channel, nick in events:
+        user = users.get(nick) or OldUser(None, nick)
+        user.username, user.hostname = 'u' + nick[6:], 'host.example'
+        users[nick] = user
+        chans.setdefault(channel, InsensitiveDict())[nick] = OldUserInChannel(user, channel)
+    return users, chans
+
+
+def new_layout(events):
+    store = ircbot.MembershipStore()
+    for channel, nick in events:
+        user = store.join(channel, nick)
+        user.username, user.hostname = 'u' + nick[6:], 'host.example'
+    return store
+
+
+def main():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    channels = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    events = make_events(users, channels)
+
+    old_bytes = deep_size(old_layout(events))
+    store = new_layout(events)
+    new_bytes = deep_size((store.users, store.channels))
+
+    start = time.time()
+    store = new_layout(events)
+    nicks = [u.nick for u in store.users.values()]
+    for nick in nicks:
+        store.rename(nick, nick + '_')
+    for nick in nicks:
+        store.quit(nick + '_')
+    elapsed = time.time() - start
+
+    print("{} users, {} channels, {} memberships".format(users, channels, len(events)))
+    print("InsensitiveDict + objects: {:8.1f} MiB".format(old_bytes / 1048576.0))
+    print("membership store:          {:8.1f} MiB".format(new_bytes / 1048576.0))
+    print("ratio: {:.1f}x".format(float(old_bytes) / new_bytes))
+    print("join + rename + quit everyone: {:.1f} ms".format(elapsed * 1e3))
+
+
+if __name__ == '__main__':
+    main()
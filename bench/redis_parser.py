@@ -0,0 +1,61 @@
+#!/usr/bin/python
+# Compares tx_redis.Reader against hiredis.Reader on bursts of pub/sub
+# pushes, fed in socket-sized chunks the way dataReceived sees them.
+#
+#   python bench/redis_parser.py [messages] [payload bytes] [chunk bytes]
+from __future__ import print_function
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import tx_redis
+
+
+def make_burst(count, size):
+    payload = 'x' * size
+    push = '*3\r\n$7\r\nmessage\r\n$16\r\nmcrelay:survival\r\n${}\r\n{}\r\n'.format(len(payload), payload)
+    return push * count
+
+
+def run(reader_class, data, chunk):
+    reader = reader_class()
+    got = 0
+    start = time.time()
+    for i in xrange(0, len(data), chunk):
+        reader.feed(data[i:i + chunk])
+        reply = reader.gets()
+        while reply is not False:
+            got += 1
+            reply = reader.gets()
+    return time.time() - start, got
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    size = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    chunk = int(sys.argv[3]) if len(sys.argv) > 3 else 65536
+    data = make_burst(count, size)
+
+    readers = [('tx_redis.Reader', tx_redis.Reader)]
+    try:
+        import hiredis
+        readers.append(('hiredis.Reader', hiredis.Reader))
+    except ImportError:
+        print("hiredis not installed, skipping it")
+
+    results = {}
+    for name, cls in readers:
+        elapsed, got = min(run(cls, data, chunk) for _ in range(3))
+        assert got == count, (name, got)
+        results[name] = elapsed
+        print("{:16} {:8.3f}s {:10.0f} msg/s".format(name, elapsed, count / elapsed))
+    if len(results) == 2:
+        print("pure python is {:.1f}x slower than hiredis".format(
+            results['tx_redis.Reader'] / results['hiredis.Reader']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+#!/usr/bin/python
+# Replays a capture recorded with the `capture` config option into the
+# handle_message paths of ircbot.Manager and websocket-server's Manager,
+# at the original pace sped up by --speed (0 for as fast as possible).
+# Both relays run against the local fake Redis and IRC servers from e2e.py,
+# with --clients simulated WebSocket clients per channel, so real traffic
+# can be profiled (--profile writes cProfile stats) without a network.
+#
+#   python bench/replay.py ircbot.capture --speed 10 --profile replay.prof
+from __future__ import print_function
+
+import argparse
+import cProfile
+import imp
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+from twisted.internet import protocol, reactor, task
+
+from capture import read_capture
+from e2e import FakeIRCdFactory, FakeRedisFactory, WebSocketClient, free_port
+
+PREFIX = 'mcrelay:'
+
+
+class Count(object):
+    def __init__(self):
+        self.messages = 0
+        self.bytes = 0
+
+    def received(self, data):
+        self.messages += 1
+        self.bytes += len(data)
+
+
+def write_config(path, channels, irc_port, redis_port, web_port):
+    irc_channels = [c for c in channels if c.startswith(PREFIX)]
+    config = {
+        'servers': {'replay': {
+            'host': '127.0.0.1', 'port': irc_port, 'nickname': 'relay',
+            'flood_rate': 1e6, 'flood_burst': 1e6,
+            'channel_map': dict(('#replay{}'.format(i), c[len(PREFIX):]) for i, c in enumerate(irc_channels)),
+        }},
+        'web': {
+            'channel_map': dict(('replay{}'.format(i), c) for i, c in enumerate(channels)),
+            'history_size': 100, 'history_mode': 'count',
+            'host': 'tcp:{}:interface=127.0.0.1'.format(web_port),
+        },
+        'redis_host': '127.0.0.1',
+        'redis_port': redis_port,
+    }
+    with open(path, 'w') as f:
+        json.dump(config, f)
+    return sorted(config['web']['channel_map'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay captured relay traffic.')
+    parser.add_argument('capture')
+    parser.add_argument('--speed', type=float, default=1.0, help='1 to 100 times real time, 0 for no pacing')
+    parser.add_argument('--target', choices=('both', 'irc', 'web'), default='both')
+    parser.add_argument('--clients', type=int, default=10, help='WebSocket clients per channel')
+    parser.add_argument('--profile', help='write cProfile stats for the replay here')
+    args = parser.parse_args()
+    capture = os.path.abspath(args.capture)
+    profile = os.path.abspath(args.profile) if args.profile else None
+
+    first = last = None
+    channels = set()
+    for when, channel, data in read_capture(capture):
+        first = when if first is None else first
+        last = when
+        channels.add(channel)
+    if first is None:
+        print("{} is empty".format(args.capture))
+        return
+
+    irc_count, web_count = Count(), Count()
+    redis = FakeRedisFactory()
+    redis_port = reactor.listenTCP(0, redis, interface='127.0.0.1').getHost().port
+    irc_port = reactor.listenTCP(0, FakeIRCdFactory(irc_count), interface='127.0.0.1').getHost().port
+    web_port = free_port()
+
+    workdir = tempfile.mkdtemp(prefix='mcrelay-replay-')
+    os.chdir(workdir)
+    web_names = write_config('config.yml', sorted(channels), irc_port, redis_port, web_port)
+
+    import ircbot
+    ws_server = imp.load_source('websocket_server', os.path.join(ROOT, 'websocket-server.py'))
+    ws_server.CONFIG = ws_server.load_config()
+    targets = []
+    if args.target in ('both', 'irc'):
+        targets.append(ircbot.Manager().handle_message)
+    if args.target in ('both', 'web'):
+        web = ws_server.Manager()
+        web.setup()
+        targets.append(web.handle_message)
+
+    records = read_capture(capture)
+    state = {'next': next(records, None), 'count': 0, 'lag': 0.0, 'start': None}
+    profiler = cProfile.Profile() if profile else None
+
+    def pump():
+        now = time.time()
+        elapsed = now - state['start']
+        record = state['next']
+        while record is not None:
+            due = (record[0] - first) / args.speed if args.speed else 0
+            if due > elapsed:
+                break
+            state['lag'] = max(state['lag'], elapsed - due)
+            for handle in targets:
+                handle(record[1], record[2])
+            state['count'] += 1
+            record = next(records, None)
+            if not args.speed and state['count'] % 1000 == 0:
+                break  # let the reactor write what has been relayed so far
+        state['next'] = record
+        if record is None:
+            loop.stop()
+
+    def start():
+        for name in web_names:
+            for i in xrange(args.clients):
+                factory = protocol.ClientFactory()
+                factory.protocol = lambda n=name: WebSocketClient('/chat/{}/socket'.format(n), web_count)
+                reactor.connectTCP('127.0.0.1', web_port, factory)
+        reactor.callLater(1.0, run)
+
+    def run():
+        if profiler:
+            profiler.enable()
+        state['start'] = time.time()
+        loop.start(0.005 if args.speed else 0).addCallback(lambda _: reactor.callLater(1.0, finish))
+
+    def finish():
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(profile)
+        wall = time.time() - state['start'] - 1.0
+        print(json.dumps({
+            'messages': state['count'],
+            'channels': len(channels),
+            'captured_seconds': last - first,
+            'replay_seconds': wall,
+            'effective_speed': (last - first) / wall if wall > 0 else None,
+            'max_lag_seconds': state['lag'],
+            'irc_lines': irc_count.messages,
+            'websocket_frames': web_count.messages,
+        }, indent=2, sort_keys=True))
+        reactor.stop()
+
+    loop = task.LoopingCall(pump)
+    reactor.callLater(1.0, start)
+    try:
+        reactor.run()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
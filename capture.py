@@ -0,0 +1,55 @@
+from __future__ import print_function
+
+import struct
+
+from twisted.internet import task
+
+
+# Append-only capture of relayed Redis messages, for replaying real traffic
+# with bench/replay.py. The file starts with MAGIC, then one record per
+# message: a header (receive time as a double, channel length, data
+# length, little endian) followed by the channel and the data.
+
+MAGIC = "MCRELAYCAP1\n"
+RECORD = struct.Struct('<dHI')
+
+
+class CaptureWriter(object):
+    flush_interval = 1.0
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'ab')
+        if self.file.tell() == 0:
+            self.file.write(MAGIC)
+        self.count = 0
+        self._flush = task.LoopingCall(self.file.flush)
+        self._flush.start(self.flush_interval, now=False)
+
+    def write(self, when, channel, data):
+        self.file.write(RECORD.pack(when, len(channel), len(data)))
+        self.file.write(channel)
+        self.file.write(data)
+        self.count += 1
+
+    def close(self):
+        if self._flush.running:
+            self._flush.stop()
+        self.file.close()
+
+
+def read_capture(path):
+    # yields (time, channel, data); a record cut short by a crash is ignored
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("{} is not a capture file".format(path))
+        while True:
+            header = f.read(RECORD.size)
+            if len(header) < RECORD.size:
+                return
+            when, channel_len, data_len = RECORD.unpack(header)
+            channel = f.read(channel_len)
+            data = f.read(data_len)
+            if len(data) < data_len:
+                return
+            yield when, channel, data
@@ -29,7 +29,12 @@ function stripColors(txt) {
 
 function relay_message(msg) {
   if (!msg) return;
-  client.publish("mcrelay:" + channel, msg);
+  if (cfg["redis_mode"] === "streams") {
+    var maxlen = (cfg["streams"] || {})["maxlen"] || 1000;
+    client.send_command("xadd", ["mcrelay:" + channel, "MAXLEN", "~", maxlen, "*", "data", msg]);
+  } else {
+    client.publish("mcrelay:" + channel, msg);
+  }
 }
 
 function translate_lang(key, data) {
@@ -1,15 +1,23 @@
 from __future__ import print_function
 
 import re
+import signal
+import string
+import time
+import zlib
 import os.path as path
 import yaml
+from collections import deque, OrderedDict
 
-from tx_redis import RedisFactory
+import metrics
+import tracing
+from capture import CaptureWriter
+from tracing import TRACER
+from tx_redis import RedisClientFactory, RedisFactory, RedisStreamFactory
 
 from twisted.words.protocols import irc
 from twisted.internet import defer, protocol, reactor, task
 from twisted.internet.interfaces import ISSLTransport
-from twisted.python.util import InsensitiveDict
 
 try:
     from OpenSSL import SSL
@@ -29,9 +37,9 @@ try:
         
         def verify(self, conn, cert, errno, errdepth, rc):
             ok = self.stripfp(cert.digest("sha1")) == self.stripfp(self.fingerprint)
-            if self.parent and self.parent.factory.reconnect and not ok:
+            if self.parent and self.parent.reconnect and not ok:
                 print("irc: server certificate verification failed")
-                self.parent.factory.reconnect = False
+                self.parent.reconnect = False
             return ok
             
         def getContext(self):
@@ -46,37 +54,192 @@ except:
     have_ssl = False
 
 
-class IRCUser(object):
-    username = ""
-    hostname = ""
-    oper = False
-    away = False
-    
-    def __init__(self, parent, nick):
-        self.parent = parent
-        self.nick = nick
+messages_received = metrics.counter(
+    'mcrelay_messages_received_total', 'Messages received from Redis.', ('channel',))
+messages_published = metrics.counter(
+    'mcrelay_messages_published_total', 'Lines from IRC published to Redis.', ('channel',))
+queue_wait_seconds = metrics.histogram(
+    'mcrelay_irc_queue_wait_seconds', 'Time relayed lines spent waiting for the flood limit.',
+    buckets=(0.01, 0.1, 0.5, 1, 2, 5, 10, 30, 60, 120))
+lines_sent = metrics.counter(
+    'mcrelay_irc_lines_sent_total', 'Relayed lines sent to IRC.', ('server', 'nick'))
+irc_connections = metrics.counter(
+    'mcrelay_irc_connections_total', 'IRC connections signed on, including reconnects.', ('server', 'nick'))
 
-    def on(self, channel):
-        return self.parent.channels.get(channel, {}).get(self.nick, False)
 
+class IRCUser(object):
+    # one record per nick the bot can see, however many channels it shares
+    # with us. `channels` holds the folded names of those channels.
+    __slots__ = ('nick', 'username', 'hostname', 'account', 'oper', 'away', 'channels')
 
-class IRCUserInChannel(object):
-    status = ""
-
-    def __init__(self, user, channel):
-        self.user = user
-        self.channel = channel
-
-    def __getattr__(self, k):
-        return getattr(self.user, k)
-    
-    @property
-    def priority(self):
-        p = self.parent.priority
-        if self.status:
-            return min([p[s] for s in self.status])
-        else:
+    def __init__(self, nick):
+        self.nick = nick
+        self.username = ""
+        self.hostname = ""
+        self.account = None
+        self.oper = False
+        self.away = False
+        self.channels = set()
+
+
+MC_COLORS = {
+    "0": "\x0301",
+    "1": "\x0302",
+    "2": "\x0303",
+    "3": "\x0310",
+    "4": "\x0304",
+    "5": "\x0306",
+    "6": "\x0308",
+    "7": "\x0315",
+    "8": "\x0314",
+    "9": "\x0312",
+    "a": "\x0309",
+    "b": "\x0311",
+    "c": "\x0304",
+    "d": "\x0313",
+    "e": "\x0308",
+    "f": "\x0F",
+}
+
+mc_color_re = re.compile(ur"\u00a7([0-9a-f])")
+
+
+def translate_colors(text):
+    return mc_color_re.sub(lambda m: MC_COLORS[m.group(1)], text)
+
+
+class LRUCache(object):
+    def __init__(self, size):
+        self.size = size
+        self.data = OrderedDict()
+
+    def get(self, key):
+        try:
+            value = self.data.pop(key)
+        except KeyError:
             return None
+        self.data[key] = value
+        return value
+
+    def put(self, key, value):
+        self.data.pop(key, None)
+        self.data[key] = value
+        if len(self.data) > self.size:
+            self.data.popitem(last=False)
+
+
+CASEMAPPINGS = {
+    "ascii": string.maketrans(string.ascii_uppercase, string.ascii_lowercase),
+    "rfc1459": string.maketrans(string.ascii_uppercase + "[]\\~", string.ascii_lowercase + "{}|^"),
+    "strict-rfc1459": string.maketrans(string.ascii_uppercase + "[]\\", string.ascii_lowercase + "{}|"),
+}
+
+
+class Channel(dict):
+    # folded nick -> status prefixes, plus the channel's name as joined
+    __slots__ = ('name',)
+
+    def __init__(self, name):
+        dict.__init__(self)
+        self.name = name
+
+
+class MembershipStore(object):
+    # Who is in which channel, keyed by names folded with the server's
+    # CASEMAPPING. Each Channel maps folded nick -> status prefixes, and each
+    # user records the channels it is in, so both directions are a dict
+    # lookup and part/kick/quit/rename only touch the channels involved.
+    # Folded names are interned: every channel dict and user shares one
+    # copy of each key. Users and channels keep their original names, which
+    # is what the keys are rebuilt from when CASEMAPPING changes.
+    def __init__(self, casemapping="rfc1459"):
+        self.table = CASEMAPPINGS[casemapping]
+        self.users = {}
+        self.channels = {}
+
+    def fold(self, name):
+        if isinstance(name, unicode):
+            name = name.encode('utf8')
+        return name.translate(self.table)
+
+    def key(self, name):
+        return intern(self.fold(name))
+
+    def set_casemapping(self, casemapping):
+        table = CASEMAPPINGS.get(casemapping, CASEMAPPINGS["rfc1459"])
+        if table == self.table:
+            return
+        self.table = table
+        users, channels = self.users, self.channels
+        self.users = dict((self.key(u.nick), u) for u in users.itervalues())
+        self.channels = {}
+        for members in channels.itervalues():
+            channel = self.channels.setdefault(self.key(members.name), Channel(members.name))
+            channel.update((self.key(users[n].nick), status) for n, status in members.iteritems())
+        for user in self.users.itervalues():
+            user.channels = set(self.key(channels[c].name) for c in user.channels)
+
+    def user(self, nick):
+        return self.users.get(self.fold(nick))
+
+    def nicks(self, channel):
+        return self.channels.get(self.fold(channel), {})
+
+    def status(self, channel, nick):
+        return self.nicks(channel).get(self.fold(nick))
+
+    def set_status(self, channel, nick, status):
+        members = self.nicks(channel)
+        nick = self.fold(nick)
+        if nick in members:
+            members[nick] = status
+
+    def join(self, channel, nick, status=""):
+        name, channel, key = channel, self.key(channel), self.key(nick)
+        user = self.users.get(key)
+        if user is None:
+            user = self.users[key] = IRCUser(intern(nick))
+        user.channels.add(channel)
+        members = self.channels.get(channel)
+        if members is None:
+            members = self.channels[channel] = Channel(name)
+        members[key] = status
+        return user
+
+    def part(self, channel, nick):
+        channel, key = self.fold(channel), self.fold(nick)
+        self.channels.get(channel, {}).pop(key, None)
+        user = self.users.get(key)
+        if user is not None:
+            user.channels.discard(channel)
+            if not user.channels:
+                del self.users[key]
+
+    def quit(self, nick):
+        key = self.fold(nick)
+        user = self.users.pop(key, None)
+        if user is not None:
+            for channel in user.channels:
+                self.channels[channel].pop(key, None)
+
+    def rename(self, old, new):
+        user = self.users.pop(self.fold(old), None)
+        if user is None:
+            return
+        old, key = self.fold(old), self.key(new)
+        user.nick = intern(new)
+        self.users[key] = user
+        for channel in user.channels:
+            members = self.channels[channel]
+            members[key] = members.pop(old)
+
+    def drop_channel(self, channel):
+        channel = self.fold(channel)
+        for key in self.channels.pop(channel, ()):
+            user = self.users[key]
+            user.channels.discard(channel)
+            if not user.channels:
+                del self.users[key]
 
 
 class SASLExternal(object):
@@ -110,29 +273,165 @@ class SASLPlain(object):
 SASL_MECHANISMS = (SASLExternal, SASLPlain)
 
 
+def split_utf8(data, limit):
+    while len(data) > limit:
+        cut = limit
+        while cut > 0 and (ord(data[cut]) & 0xC0) == 0x80:
+            cut -= 1
+        yield data[:cut]
+        data = data[cut:]
+    if data:
+        yield data
+
+
+class OutboundQueue(object):
+    # Rate limits a connection with a token bucket: `rate` tokens a second,
+    # at most `burst` saved up, one spent per line sent. Every line the bot
+    # writes is charged (so JOINs and WHOs count too), but only relayed
+    # lines wait for tokens. They are queued per channel and the channels
+    # take turns. When there are more lines waiting than tokens, a channel's
+    # waiting lines are joined into as few PRIVMSGs as fit in `max_length`
+    # bytes. A rate of 0 (or less) turns the limit off.
+    separator = "\x0f | "
+
+    def __init__(self, bot, rate, burst, max_length, labels=()):
+        self.bot = bot
+        self.labels = labels
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.max_length = max_length
+        self.tokens = burst
+        self.last = time.time()
+        self.queues = {}
+        self.turns = deque()
+        self.depth = 0
+        self._call = None
+
+    def refill(self):
+        if self.rate <= 0:
+            self.tokens = float('inf')
+            return
+        now = time.time()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def spend(self):
+        self.refill()
+        self.tokens -= 1
+
+    def enqueue(self, channel, text):
+        if isinstance(text, unicode):
+            text = text.encode('utf8', 'replace')
+        if isinstance(channel, unicode):
+            channel = channel.encode('utf8')
+        limit = self.max_length - len("PRIVMSG {} :".format(channel))
+        queue = self.queues.setdefault(channel, deque())
+        now = time.time()
+        # one message per line, as IRCClient.msg sends them
+        for line in text.split('\n'):
+            for chunk in split_utf8(line, limit):
+                queue.append((now, chunk))
+                self.depth += 1
+        if not queue:
+            return
+        if channel not in self.turns:
+            self.turns.append(channel)
+        self.schedule()
+
+    def schedule(self):
+        if self._call is not None or not self.turns:
+            return
+        self.refill()
+        delay = 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+        self._call = reactor.callLater(delay, self.run)
+
+    def run(self):
+        self._call = None
+        self.refill()
+        while self.tokens >= 1 and self.turns:
+            channel = self.turns.popleft()
+            queue = self.queues[channel]
+            self.bot.sendLine("PRIVMSG {} :{}".format(channel, self.coalesce(channel, queue)))
+            if queue:
+                self.turns.append(channel)
+        self.schedule()
+
+    def coalesce(self, channel, queue):
+        limit = self.max_length - len("PRIVMSG {} :".format(channel))
+        now = time.time()
+        queued, text = queue.popleft()
+        self.record(now - queued)
+        if self.tokens > self.depth:
+            return text
+        while queue and len(text) + len(self.separator) + len(queue[0][1]) <= limit:
+            queued, more = queue.popleft()
+            self.record(now - queued)
+            text += self.separator + more
+        return text
+
+    def record(self, wait):
+        queue_wait_seconds.observe(wait)
+        lines_sent.inc(self.labels)
+        self.depth -= 1
+
+    def stop(self):
+        if self._call is not None:
+            self._call.cancel()
+            self._call = None
+
+
 class IRCBot(irc.IRCClient):
     sasl_buffer = ""
     sasl_result = None
     sasl_login = None
 
-    cancel_hilight_re = re.compile(ur"(?:(?<=\u00a7[0-9a-flmnor])|(?<!\u00a7)\b).+?\b")
+    # Membership is kept up to date from NAMES, JOIN, PART, KICK, QUIT and
+    # NICK, plus these capabilities where the server has them. WHO is only
+    # sent by the refresh loop (one per connection, at most one WHO per
+    # tick), once for each channel we join and again for a channel if
+    # someone we don't have as a member talks in it.
+    membership_caps = ('multi-prefix', 'userhost-in-names', 'extended-join',
+                       'away-notify', 'account-notify')
+    refresh_interval = 5
+    refresh_loop = None
+    whox_token = "152"
+
+    # runs of nick characters (group 1). mIRC colour codes and leftover
+    # minecraft formatting codes are matched separately so their digits and
+    # letters don't stick to the word after them.
+    nick_token_re = re.compile(ur"\x03\d{0,2}(?:,\d{1,2})?|\u00a7[0-9a-fk-or]|([A-Za-z0-9_\-\[\]\\`^{}|]+)")
 
     def __init__(self, factory, parent):
         self.factory     = factory
-        self.nickname    = parent.nickname.encode('ascii')
+        self.nickname    = factory.nickname.encode('ascii')
         self.realname    = parent.realname.encode('ascii')
         self.username    = parent.ident.encode('ascii')
         self.ns_username = parent.username
         self.ns_password = parent.password
         self.password    = parent.server_password.encode('ascii')
-        self.join_channels = parent.channel_map.keys()
 
-        self.users        = InsensitiveDict()
-        self.channels     = InsensitiveDict()
+        self.members      = MembershipStore()
         self.cap_requests = set()
+        self.capabilities = set()
+        self.in_channels  = []
+        self.resync       = deque()
 
         self.parent = parent
 
+        # the server prefixes relayed lines with our nick!ident@host, so
+        # leave room for that (and the longest hostname) in the 512 bytes
+        max_length = 510 - len(":{}!{}@ ".format(self.nickname, self.username)) - 63
+        self.outbound = OutboundQueue(self, parent.flood_rate, parent.flood_burst, max_length,
+                                      (parent.name, self.nickname))
+
+    def connectionLost(self, reason):
+        self.outbound.stop()
+        if self.factory.client is self:
+            self.factory.client = None
+        if self.refresh_loop and self.refresh_loop.running:
+            self.refresh_loop.stop()
+        irc.IRCClient.connectionLost(self, reason)
+
     def register(self, nickname, hostname="foo", servername="bar"):
         self.sendLine("CAP LS")
         return irc.IRCClient.register(self, nickname, hostname, servername)
@@ -140,6 +439,7 @@ class IRCBot(irc.IRCClient):
     def sendLine(self, line):
         if isinstance(line, unicode):
             line = line.encode('utf8', 'replace')
+        self.outbound.spend()
         irc.IRCClient.sendLine(self, line)
 
     def _parse_cap(self, cap):
@@ -168,6 +468,9 @@ class IRCBot(irc.IRCClient):
         args = args.split(' ')
         if subcommand == "LS":
             self.sasl_start(args)
+            wanted = [cap for cap in self.membership_caps if cap in args]
+            if wanted:
+                self.request_cap(*wanted)
             if not self.cap_requests:
                 self.sendLine("CAP END")
         elif subcommand == "ACK":
@@ -177,10 +480,10 @@ class IRCBot(irc.IRCClient):
                     continue
                 cap, mod, vendor = self._parse_cap(cap)
                 if '-' in mod:
-                    if cap in self.capabilities:
-                        del self.capabilities[cap]
+                    self.capabilities.discard(cap)
                     continue
-                self.cap_requests.remove(cap)
+                self.capabilities.add(cap)
+                self.cap_requests.discard(cap)
                 if cap == 'sasl':
                     self.sasl_next()
             if ack:
@@ -190,7 +493,7 @@ class IRCBot(irc.IRCClient):
         elif subcommand == "NAK":
             # this implementation is probably not compliant but it will have to do for now
             for cap in args:
-                self.cap_requests.remove(cap)
+                self.cap_requests.discard(cap)
             if not self.cap_requests:
                 self.end_cap()
 
@@ -206,26 +509,83 @@ class IRCBot(irc.IRCClient):
         if self.ns_username and self.ns_password and not self.sasl_login:
             self.msg('NickServ', 'IDENTIFY {0} {1}'.format(self.ns_username, self.ns_password))
         
-        for channel in self.join_channels:
+        self.factory.client = self
+        irc_connections.inc((self.parent.name, self.nickname))
+        for channel in sorted(self.factory.channels):
             self.join(channel)
 
+        self.refresh_loop = task.LoopingCall(self.refresh)
+        self.refresh_loop.start(self.refresh_interval, now=False)
+
+    def refresh(self):
+        if self.resync:
+            self.who(self.resync.popleft())
+
+    def check_member(self, user, channel):
+        if channel in self.in_channels and channel not in self.resync \
+                and self.members.status(channel, user.split('!')[0]) is None:
+            self.resync.append(channel)
+
+    def who(self, channel):
+        if self.supported.hasFeature("WHOX"):
+            self.sendLine("WHO {} %tcuhnfa,{}".format(channel, self.whox_token))
+        else:
+            self.sendLine("WHO " + channel)
+
     def irc_JOIN(self, prefix, params):
         nick = prefix.split('!')[0]
-        channel = params[-1]
+        channel = params[0]
         if nick == self.nickname:
             self.joined(channel)
         else:
             self.userJoined(prefix, channel)
+            if 'extended-join' in self.capabilities and len(params) > 1:
+                self.members.user(nick).account = None if params[1] == '*' else params[1]
 
     def joined(self, channel):
         print('irc: joined channel')
-        self.factory.client = self
-        def who():
-            self.sendLine("WHO " + channel)
-        task.LoopingCall(who).start(30)
+        if channel not in self.in_channels:
+            self.in_channels.append(channel)
+        self.resync.append(channel)
+
+    def irc_AWAY(self, prefix, params):
+        user = self.members.user(prefix.split('!')[0])
+        if user:
+            user.away = bool(params and params[0])
+
+    def irc_ACCOUNT(self, prefix, params):
+        user = self.members.user(prefix.split('!')[0])
+        if user:
+            user.account = None if params[0] == '*' else params[0]
+
+    def irc_RPL_NAMREPLY(self, prefix, params):
+        channel, names = params[2], params[3]
+        priority = self.prefix_priority()
+        for entry in names.split():
+            i = 0
+            while i < len(entry) and entry[i] in priority:
+                i += 1
+            status, entry = entry[:i], entry[i:]
+            nick, _, userhost = entry.partition('!')
+            if not nick or nick == self.nickname:
+                continue
+            user = self.members.join(channel, nick, self.parse_prefixes(status))
+            if userhost:
+                user.username, _, user.hostname = userhost.partition('@')
+
+    def irc_354(self, prefix, params):
+        # WHOX reply for "%tcuhnfa": token channel user host nick flags account
+        if len(params) < 8 or params[1] != self.whox_token:
+            return
+        _, _, channel, username, host, nick, status, account = params[:8]
+        self.irc_RPL_WHOREPLY(prefix, [None, channel, username, host, None, nick, status, "0 "])
+        user = self.members.user(nick)
+        if user:
+            user.account = None if account == '0' else account
     
     def isupport(self, args):
         self.compute_prefix_names()
+        self.members.set_casemapping(self.supported.getFeature("CASEMAPPING", ("rfc1459",))[0])
         
     def compute_prefix_names(self):
         KNOWN_NAMES = {"o": "op", "h": "halfop", "v": "voice"}
@@ -250,106 +610,96 @@ class IRCBot(irc.IRCClient):
             self.priority[mode] = priority
             self.priority[prefix] = priority
 
-    def parse_prefixes(self, user, nick, prefixes=''):
-        status = []
-        prefixdata = self.supported.getFeature("PREFIX", {"o": ("@", 0), "v": ("+", 1)}).items()
-        for mode, (prefix, priority) in prefixdata:
-            if prefix in prefixes + nick:
-                nick = nick.replace(prefix, '')
-                status.append((prefix, priority))
-        if nick == self.nickname:
-            return
-        user.status = ''.join(t[0] for t in sorted(status, key=lambda t: t[1]))
+    def prefix_priority(self):
+        prefixdata = self.supported.getFeature("PREFIX", {"o": ("@", 0), "v": ("+", 1)}).values()
+        return dict(prefixdata)
+
+    def parse_prefixes(self, prefixes):
+        priority = self.prefix_priority()
+        return ''.join(sorted(set(p for p in prefixes if p in priority), key=priority.get))
     
     def irc_RPL_WHOREPLY(self, prefix, params):
         _, channel, username, host, server, nick, status, hg = params
         if nick == self.nickname:
             return
         hops, gecos = hg.split(' ', 1)
-        user = self.get_user(nick) or IRCUser(self, nick)
+        user = self.members.join(channel, nick, self.parse_prefixes(status[1:]))
         user.username = username
         user.hostname = host
         user.oper = '*' in status
         user.away = status[0] == 'G'
-        self.users[nick] = user
-        self.get_channel(channel)[nick] = IRCUserInChannel(user, channel)
-        self.parse_prefixes(user, nick, status[1:].replace('*', ''))
     
     def modeChanged(self, user, channel, _set, modes, args):
         args = list(args)
-        if channel not in self.parent.channel_map:
+        if channel not in self.factory.channels:
             return
         for m, arg in zip(modes, args):
             if m in self.prefixes and arg != self.nickname:
-                u = self.get_user(arg).on(channel)
-                if u:
-                    u.status = u.status.replace(self.prefixes[m], '')
-                    if _set:
-                        u.status = ''.join(sorted(list(u.status + self.prefixes[m]),
-                                                  key=lambda k: self.priority[k]))
-
-    def has_status(self, nick, status):
+                status = self.members.status(channel, arg)
+                if status is None:
+                    continue
+                status = status.replace(self.prefixes[m], '')
+                if _set:
+                    status = ''.join(sorted(status + self.prefixes[m], key=self.priority.get))
+                self.members.set_status(channel, arg, status)
+
+    def has_status(self, channel, nick, status):
         if status != 0 and not status:
             return True
         if status not in self.priority:
             return False
-        priority = self.priority[status]
-        u = self.users.get(nick, None)
-        return u and (u.priority is not None) and u.priority <= priority
-
-    def get_channel(self, channel):
-        return self.channels.setdefault(channel, InsensitiveDict())
+        current = self.members.status(channel, nick)
+        if not current:
+            return False
+        return min(self.priority[p] for p in current) <= self.priority[status]
 
-    def get_user(self, nick):
-        return self.users.get(nick, False)
-    
     def userJoined(self, user, channel):
-        nick = user.split('!')[0]
-        user = IRCUser(self, nick)
-        self.users[nick] = user
-        self.get_channel(channel)[nick] = IRCUserInChannel(user, channel)
+        nick, _, userhost = user.partition('!')
+        user = self.members.join(channel, nick)
+        if userhost:
+            user.username, _, user.hostname = userhost.partition('@')
     
     def userRenamed(self, oldname, newname):
-        if oldname not in self.users:
-            return
-        u = self.users[oldname]
-        u.nick = newname
-        self.users[newname] = u
-        del self.users[oldname]
-        for k, v in self.channels.items():
-            if oldname in v:
-                v[newname] = v[oldname]
-                del v[oldname]
+        self.members.rename(oldname, newname)
     
+    def left(self, channel):
+        self.members.drop_channel(channel)
+        if channel in self.in_channels:
+            self.in_channels.remove(channel)
+
+    def kickedFrom(self, channel, kicker, message):
+        self.left(channel)
+
     def userLeft(self, user, channel):
-        if user not in self.users:
-            return
-        del self.users[user]
-        for k, v in self.channels.items():
-            if user in v:
-                del v[user]
+        self.members.part(channel, user)
     
     def userKicked(self, kickee, channel, kicker, message):
-        if kickee not in self.users:
-            return
-        del self.users[kickee]
-        for k, v in self.channels.items():
-            if user in v:
-                del v[user]
+        self.members.part(channel, kickee)
     
     def userQuit(self, user, quitMessage):
-        if user not in self.users:
-            return
-        del self.users[user]
-        for k, v in self.channels.items():
-            if user in v:
-                del v[user]
+        self.members.quit(user)
 
     def privmsg(self, user, channel, msg):
-        pass
+        self.check_member(user, channel)
+        self.relay_out(user, channel, "<{}> {}", msg)
 
     def action(self, user, channel, msg):
-        pass
+        self.check_member(user, channel)
+        self.relay_out(user, channel, "* {} {}", msg)
+
+    def relay_out(self, user, channel, fmt, msg):
+        if not self.parent.publish or self.parent.manager is None:
+            return
+        if channel not in self.factory.channels:
+            key = self.members.fold(channel)
+            for name in self.factory.channels:
+                if self.members.fold(name) == key:
+                    channel = name
+                    break
+            else:
+                return  # private message, or a channel that isn't relayed
+        nick = user.split('!', 1)[0]
+        self.parent.manager.irc_message(self.factory, channel, fmt.format(nick, irc.stripFormatting(msg)))
 
     def irc_AUTHENTICATE(self, prefix, params):
         self.sasl_continue(params[0])
@@ -433,47 +783,40 @@ class IRCBot(irc.IRCClient):
         return nickname + '_'
 
     def cancel_hilights(self, channel, text):
-        def hl(match):
-            s = match.group(0)
-            if len(s) >= 2 and s in self.get_channel(channel):
-                return s[:-1] + '*' + s[-1]
-            else:
-                return s
-        return self.cancel_hilight_re.sub(hl, text)
-
-    def translate_colors(self, text):
-        tr = {
-            "0": "\x0301",
-            "1": "\x0302",
-            "2": "\x0303",
-            "3": "\x0310",
-            "4": "\x0304",
-            "5": "\x0306",
-            "6": "\x0308",
-            "7": "\x0315",
-            "8": "\x0314",
-            "9": "\x0312",
-            "a": "\x0309",
-            "b": "\x0311",
-            "c": "\x0304",
-            "d": "\x0313",
-            "e": "\x0308",
-            "f": "\x0F",
-        }
-        return re.sub(ur"\u00a7([0-9a-f])", lambda m: tr.get(m.group(1), ""), text)
-
-    def irc_relay(self, channel, message):
-        message = message.decode('utf8')
-        self.say(channel, self.translate_colors(self.cancel_hilights(channel, message)))
+        nicks = self.members.nicks(channel)
+        if not nicks:
+            return text
+        table = self.members.table
+        out = []
+        last = 0
+        for m in self.nick_token_re.finditer(text):
+            word = m.group(1)
+            # nick_token_re only matches ASCII in group 1
+            if word and len(word) >= 2 and str(word).translate(table) in nicks:
+                end = m.end() - 1
+                out.append(text[last:end])
+                out.append(u'*')
+                last = end
+        if not out:
+            return text
+        out.append(text[last:])
+        return u''.join(out)
+
+    def irc_relay(self, channel, text):
+        self.outbound.enqueue(channel, self.cancel_hilights(channel, text))
 
 
 class IRCBotFactory(protocol.ClientFactory):
+    # One connection to a network, joined to `channels` (a subset of the
+    # server's channel_map when it is sharded) as `nickname`.
     protocol = IRCBot
     client = None
     reconnect = True
 
-    def __init__(self, parent):
+    def __init__(self, parent, nickname, channels):
         self.parent = parent
+        self.nickname = nickname
+        self.channels = set(channels)
 
     def clientConnectionLost(self, connector, reason):
         if self.reconnect:
@@ -494,6 +837,10 @@ class IRCBotFactory(protocol.ClientFactory):
 
 
 class IRC(object):
+    name = ""
+    factories = ()
+    manager = None
+
     #connection
     host               = "vimes.rozznet.net"
     port               = 6667
@@ -502,6 +849,10 @@ class IRC(object):
     certificate        = ""
     ssl                = False
     server_fingerprint = ""
+    flood_rate         = 0.5
+    flood_burst        = 5
+    shards             = 1
+    publish            = False
 
     #user
     nickname = "MC-Relay"
@@ -510,63 +861,244 @@ class IRC(object):
     username = ""
     password = ""
 
+    def shard_nickname(self, n):
+        if n == 0:
+            return self.nickname
+        return "{}{}".format(self.nickname, n + 1)
+
+    def shard_of(self, channel):
+        # stable across restarts, so a channel keeps its connection (and the
+        # nick it is known by) as long as the shard count doesn't change
+        return zlib.crc32(channel.lower().encode('utf8')) % len(self.factories)
+
+    def factory_for(self, channel):
+        return self.factories[self.shard_of(channel)]
+
     def start(self):
-        self.factory = IRCBotFactory(self)
+        # Each shard is its own connection with its own nick, flood budget
+        # and reconnect cycle; channels are split between them by name.
+        if self.ssl and not have_ssl:
+            print("Couldn't load SSL for IRC!")
+            return
+        count = max(1, int(self.shards))
+        self.factories = [IRCBotFactory(self, self.shard_nickname(n), ()) for n in range(count)]
+        for channel in self.channel_map:
+            self.factory_for(channel).channels.add(channel)
+        for factory in self.factories:
+            self.connect(factory)
+
+    def connect(self, factory):
         if self.ssl:
-            if have_ssl:
-                cf = RelayContextFactory(self,
-                                         cert=self.certificate,
-                                         fingerprint=self.server_fingerprint)
-                reactor.connectSSL(self.host, self.port, self.factory, cf)
-            else:
-                print("Couldn't load SSL for IRC!")
-                return
+            cf = RelayContextFactory(factory,
+                                     cert=self.certificate,
+                                     fingerprint=self.server_fingerprint)
+            reactor.connectSSL(self.host, self.port, factory, cf)
         else:
-            reactor.connectTCP(self.host, self.port, self.factory)
+            reactor.connectTCP(self.host, self.port, factory)
 
     def stop(self):
-        self.factory.reconnect = False
-        if self.factory.client:
-            self.factory.client.quit("Relay stopping.")
+        for factory in self.factories:
+            factory.reconnect = False
+            if factory.client:
+                factory.client.quit("Relay stopping.")
+
+    # a server that didn't start (no SSL) has no factories; its channel_map
+    # is still kept up to date, but build_routes() skips it
+
+    def add_channel(self, channel, redis_channel):
+        self.channel_map[channel] = redis_channel
+        if not self.factories:
+            return
+        factory = self.factory_for(channel)
+        if channel not in factory.channels:
+            factory.channels.add(channel)
+            if factory.client:
+                factory.client.join(channel)
+
+    def remove_channel(self, channel):
+        del self.channel_map[channel]
+        if not self.factories:
+            return
+        factory = self.factory_for(channel)
+        factory.channels.discard(channel)
+        if factory.client:
+            factory.client.leave(channel)
 
 
 class Manager(object):
+    max_echoes = 1000
+
     def __init__(self):
         with open("config.yml") as f:
             self.config = yaml.load(f)
 
-        channels = set()
-        self.channel_map = {}
+        self.transform_cache = LRUCache(self.config.get('transform_cache', 256))
+        self.streams = self.config.get('redis_mode') == 'streams'
+        # (redis channel, data) -> origins of lines we published ourselves,
+        # so they aren't relayed back to the IRC channel they came from
+        self.echoes = OrderedDict()
 
         self.servers = {}
 
         for name, cfg in self.config['servers'].items():
-            self.servers[name] = irc = IRC()
-            for k, v in cfg.items():
-                setattr(irc, k, v)
-            for k, v in irc.channel_map.items():
-                irc.channel_map[k] = v = "mcrelay:" + v
-                channels.add(v)
-                self.channel_map.setdefault(v, set()).add(irc)
-            irc.start()
-
-        self.redis_factory = RedisFactory(self, channels)
+            self.add_server(name, cfg)
+
+        self.build_routes()
+        channels = set(self.routes)
+
+        if self.streams:
+            streams = self.config.get('streams', {})
+            self.redis_factory = RedisStreamFactory(self, channels, streams.get('irc_state'))
+        else:
+            self.redis_factory = RedisFactory(self, channels)
+        if self.config.get('capture', {}).get('irc'):
+            self.redis_factory.capture = CaptureWriter(self.config['capture']['irc'])
         reactor.connectTCP(self.config['redis_host'], self.config['redis_port'], self.redis_factory)
 
+        # lines from IRC go out on a separate command connection; commands
+        # issued in the same reactor tick are written together, and they are
+        # queued while the connection is down
+        self.publisher = RedisClientFactory(self, queue=True)
+        reactor.connectTCP(self.config['redis_host'], self.config['redis_port'], self.publisher)
+
+        metrics.callback('mcrelay_irc_queue_depth', 'Relayed lines waiting for the flood limit.',
+                         self.queue_depths, ('server', 'nick'))
+        if self.config.get('metrics', {}).get('irc'):
+            metrics.listen(self.config['metrics']['irc'])
+
         reactor.addSystemEventTrigger("before", "shutdown", self.on_shutdown)
 
     def on_shutdown(self):
         for irc in self.servers.values():
             irc.stop()
+        if self.redis_factory.capture:
+            self.redis_factory.capture.close()
+
+    def queue_depths(self):
+        depths = {}
+        for irc in self.servers.values():
+            for factory in irc.factories:
+                if factory.client:
+                    depths[(irc.name, factory.nickname)] = factory.client.outbound.depth
+        return depths
+
+    def add_server(self, name, cfg):
+        self.servers[name] = irc = IRC()
+        irc.name = name
+        irc.manager = self
+        for k, v in cfg.items():
+            setattr(irc, k, v)
+        irc.channel_map = dict((k, "mcrelay:" + v) for k, v in cfg['channel_map'].items())
+        irc.start()
+
+    # server settings that can change without reconnecting
+    live_settings = ('channel_map', 'publish')
+
+    def reload(self):
+        # SIGHUP: re-read config.yml and apply the difference. Servers whose
+        # connection settings changed are reconnected; for the rest, channels
+        # are joined and parted on the connections that are already up.
+        # Redis settings and everything outside `servers` need a restart.
+        try:
+            with open("config.yml") as f:
+                config = yaml.load(f)
+        except Exception as e:
+            print("config: reload failed: {}".format(e))
+            return
+        old_servers, new_servers = self.config['servers'], config['servers']
+        for name in set(old_servers) - set(new_servers):
+            print("config: removing server {}".format(name))
+            self.servers.pop(name).stop()
+        for name, cfg in new_servers.items():
+            old = old_servers.get(name)
+            if old is None:
+                print("config: adding server {}".format(name))
+                self.add_server(name, cfg)
+                continue
+            changed = set(k for k in set(old) | set(cfg) if old.get(k) != cfg.get(k))
+            if changed - set(self.live_settings):
+                print("config: reconnecting to {} ({} changed)".format(name, ", ".join(sorted(changed))))
+                self.servers.pop(name).stop()
+                self.add_server(name, cfg)
+                continue
+            irc = self.servers[name]
+            irc.publish = cfg.get('publish', IRC.publish)
+            new_map = dict((k, "mcrelay:" + v) for k, v in cfg['channel_map'].items())
+            for channel in set(irc.channel_map) - set(new_map):
+                irc.remove_channel(channel)
+            for channel, redis_channel in new_map.items():
+                irc.add_channel(channel, redis_channel)
+        self.config['servers'] = new_servers
+
+        old_channels = set(self.routes)
+        self.build_routes()
+        channels = set(self.routes)
+        self.redis_factory.unsubscribe(old_channels - channels)
+        self.redis_factory.subscribe(channels - old_channels)
+        print("config: reloaded, {} redis channels (+{} -{})".format(
+            len(channels), len(channels - old_channels), len(old_channels - channels)))
+
+    def transform(self, data):
+        # The part of the relay pipeline that is the same for every IRC
+        # destination (decoding and colour translation). It runs once per
+        # message, and repeated lines (broadcasts, join/leave spam) come
+        # from the cache. Hilight cancelling depends on the channel and is
+        # left to each IRCBot.
+        text = self.transform_cache.get(data)
+        if text is None:
+            text = translate_colors(data.decode('utf8', 'replace'))
+            self.transform_cache.put(data, text)
+        return text
+
+    def build_routes(self):
+        # redis channel -> [(IRCBotFactory, irc channel), ...]. Rebuild this
+        # whenever a server's channel_map changes.
+        routes = {}
+        for irc in self.servers.values():
+            if not irc.factories:
+                continue
+            for irc_channel, redis_channel in irc.channel_map.items():
+                routes.setdefault(redis_channel, []).append((irc.factory_for(irc_channel), irc_channel))
+        self.routes = routes
+
+    def irc_message(self, factory, irc_channel, data):
+        channel = factory.parent.channel_map[irc_channel]
+        messages_published.inc((channel,))
+        self.echoes.setdefault((channel, data), []).append((factory, irc_channel))
+        if len(self.echoes) > self.max_echoes:
+            self.echoes.popitem(last=False)
+        if self.streams:
+            d = self.publisher.xadd(channel, data, self.config.get('streams', {}).get('maxlen'))
+        else:
+            d = self.publisher.publish(channel, data)
+        d.addErrback(lambda f: print("redis: publish failed: {}".format(f.getErrorMessage())))
 
     def handle_message(self, channel, data):
-        relays = self.channel_map.get(channel, [])
-        for irc in relays:
-            for k, v in irc.channel_map.items():
-                if v == channel:
-                    irc.factory.irc_relay(k, data)
+        messages_received.inc((channel,))
+        targets = self.routes.get(channel)
+        if not targets:
+            return
+        trace = TRACER.start(channel)
+        origin = None
+        origins = self.echoes.get((channel, data))
+        if origins:
+            origin = origins.pop(0)
+            if not origins:
+                del self.echoes[(channel, data)]
+        text = self.transform(data)
+        TRACER.mark(trace, 'transform')
+        for target in targets:
+            if target != origin:
+                target[0].irc_relay(target[1], text)
+        TRACER.mark(trace, 'hilights_queued')
+        TRACER.finish(trace)
+
+    def handle_pmessage(self, pattern, channel, data):
+        self.handle_message(channel, data)
 
 
 if __name__ == '__main__':
     m = Manager()
+    tracing.setup(m.config.get('tracing', {}), 'ircbot')
+    signal.signal(signal.SIGHUP, lambda signum, frame: reactor.callFromThread(m.reload))
     reactor.run()
@@ -0,0 +1,158 @@
+from __future__ import print_function
+
+import bisect
+
+from twisted.application.strports import listen as listen_strport
+from twisted.web import resource, server
+
+
+# Counters, gauges and histograms served in the Prometheus text format.
+# Recording is a dict update (plus a bisect for histograms); anything that
+# can be read off existing state (client counts, queue depths) is a
+# callback metric that only does work when scraped.
+
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+
+def escape(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def format_labels(names, values, extra=()):
+    pairs = ['{}="{}"'.format(k, escape(v)) for k, v in zip(names, values)]
+    pairs.extend('{}="{}"'.format(k, v) for k, v in extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Metric(object):
+    kind = 'untyped'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+
+    def samples(self):
+        return []
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help),
+                 '# TYPE {} {}'.format(self.name, self.kind)]
+        for suffix, values, extra, value in self.samples():
+            lines.append('{}{}{} {}'.format(self.name, suffix,
+                                            format_labels(self.labels, values, extra),
+                                            format_value(value)))
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        Metric.__init__(self, name, help, labels)
+        self.values = {}
+
+    def inc(self, labels=(), amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        return [('', k, (), v) for k, v in sorted(self.values.items())]
+
+
+class Callback(Metric):
+    # fn() returns {label values: value}, or a number if there are no labels
+    def __init__(self, name, help, labels=(), fn=None, kind='gauge'):
+        Metric.__init__(self, name, help, labels)
+        self.fn = fn
+        self.kind = kind
+
+    def samples(self):
+        values = self.fn()
+        if not isinstance(values, dict):
+            values = {(): values}
+        return [('', k, (), v) for k, v in sorted(values.items())]
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        Metric.__init__(self, name, help, labels)
+        self.buckets = list(buckets)
+        self.values = {}  # labels -> [count per bucket..., +Inf count, sum]
+
+    def observe(self, value, labels=()):
+        counts = self.values.get(labels)
+        if counts is None:
+            counts = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def samples(self):
+        out = []
+        for labels, counts in sorted(self.values.items()):
+            total = 0
+            for bound, count in zip(self.buckets + [float('inf')], counts):
+                total += count
+                out.append(('_bucket', labels, (('le', format_value(bound)),), total))
+            out.append(('_sum', labels, (), counts[-1]))
+            out.append(('_count', labels, (), total))
+        return out
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric):
+        # re-registering a name replaces the old metric
+        self.metrics[metric.name] = metric
+        return metric
+
+    def render(self):
+        return '\n'.join(m.render() for _, m in sorted(self.metrics.items())) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def counter(name, help, labels=()):
+    return REGISTRY.register(Counter(name, help, labels))
+
+
+def callback(name, help, fn, labels=(), kind='gauge'):
+    return REGISTRY.register(Callback(name, help, labels, fn, kind))
+
+
+def histogram(name, help, labels=(), buckets=LATENCY_BUCKETS):
+    return REGISTRY.register(Histogram(name, help, labels, buckets))
+
+
+class MetricsResource(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, registry=REGISTRY):
+        resource.Resource.__init__(self)
+        self.registry = registry
+
+    def render_GET(self, request):
+        request.setHeader('Content-Type', 'text/plain; version=0.0.4')
+        return self.registry.render()
+
+
+def listen(description, offset=0, registry=REGISTRY):
+    # `description` is a strports string ("tcp:9100:interface=127.0.0.1");
+    # offset is added to the port, so each worker process gets its own.
+    if offset:
+        parts = description.split(':')
+        parts[1] = str(int(parts[1]) + offset)
+        description = ':'.join(parts)
+    print("metrics: serving on {}".format(description))
+    return listen_strport(description, server.Site(MetricsResource(registry)))
@@ -0,0 +1,141 @@
+from __future__ import print_function
+
+import cProfile
+import json
+import os
+import signal
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+
+from twisted.internet import reactor, task
+
+
+# Diagnostics for a lagging relay, all off unless configured:
+#
+# - Tracer: one message in every 1/sample_rate gets a timestamp at each
+#   stage of the relay; finished traces go to a ring buffer that SIGUSR1
+#   dumps to a JSON file. Unsampled messages cost one counter decrement.
+# - StallDetector: a watchdog thread that prints the main thread's stack
+#   whenever the reactor hasn't run its heartbeat for stall_ms, and the
+#   length of the stall once it's over.
+# - SIGUSR2 runs cProfile for profile_seconds and writes a pstats file.
+
+
+class Tracer(object):
+    def __init__(self, sample_rate=0, size=1000):
+        self.chunk_times = (0.0, 0.0)
+        self.configure(sample_rate, size)
+
+    def configure(self, sample_rate, size):
+        # traces kept so far are dropped
+        self.every = int(round(1 / sample_rate)) if sample_rate else 0
+        self.countdown = self.every
+        self.traces = deque(maxlen=size)
+
+    def chunk(self, received, parsed):
+        # times the Redis data currently being handled arrived and was parsed
+        self.chunk_times = (received, parsed)
+
+    def start(self, channel):
+        if not self.every:
+            return None
+        self.countdown -= 1
+        if self.countdown > 0:
+            return None
+        self.countdown = self.every
+        received, parsed = self.chunk_times
+        return [channel, ('received', received), ('parsed', parsed)]
+
+    def mark(self, trace, stage):
+        if trace is not None:
+            trace.append((stage, time.time()))
+
+    def finish(self, trace):
+        if trace is not None:
+            self.traces.append(trace)
+
+    def dump(self, path):
+        with open(path, 'w') as f:
+            for trace in self.traces:
+                start = trace[1][1]
+                stages = [(name, round((t - start) * 1e3, 3)) for name, t in trace[1:]]
+                f.write(json.dumps({'channel': trace[0], 'time': start, 'ms': stages}) + '\n')
+        print("tracing: wrote {} traces to {}".format(len(self.traces), path))
+
+
+TRACER = Tracer()
+
+
+class StallDetector(object):
+    def __init__(self, stall_ms):
+        self.threshold = stall_ms / 1000.0
+        self.interval = self.threshold / 4
+        self.beat = time.time()
+        self.reported = False
+        self.main_thread = threading.current_thread().ident
+
+    def start(self):
+        task.LoopingCall(self.heartbeat).start(self.interval)
+        thread = threading.Thread(target=self.watch, name="stall-detector")
+        thread.daemon = True
+        thread.start()
+
+    def heartbeat(self):
+        now = time.time()
+        gap = now - self.beat
+        if gap > self.threshold:
+            print("tracing: reactor stalled for {:.0f} ms".format(gap * 1e3))
+        self.beat = now
+        self.reported = False
+
+    def watch(self):
+        while True:
+            time.sleep(self.interval)
+            age = time.time() - self.beat
+            if age > self.threshold and not self.reported:
+                self.reported = True
+                frame = sys._current_frames().get(self.main_thread)
+                stack = ''.join(traceback.format_stack(frame)) if frame else ''
+                print("tracing: reactor blocked for {:.0f} ms in:\n{}".format(age * 1e3, stack))
+
+
+class ProfileWindow(object):
+    def __init__(self, seconds, directory, name):
+        self.seconds = seconds
+        self.directory = directory
+        self.name = name
+        self.profiler = None
+
+    def start(self):
+        if self.profiler is not None:
+            return
+        print("tracing: profiling for {} seconds".format(self.seconds))
+        self.profiler = cProfile.Profile()
+        self.profiler.enable()
+        reactor.callLater(self.seconds, self.stop)
+
+    def stop(self):
+        self.profiler.disable()
+        path = os.path.join(self.directory, "{}-{}-{}.pstats".format(self.name, os.getpid(), int(time.time())))
+        self.profiler.dump_stats(path)
+        self.profiler = None
+        print("tracing: wrote profile to {}".format(path))
+
+
+def setup(config, name):
+    # `config` is the tracing section of config.yml; `name` prefixes the
+    # files written. Signal handlers are installed even when sampling is
+    # off, so a profile can always be taken.
+    directory = config.get('dir', '.')
+    TRACER.configure(config.get('sample_rate', 0), config.get('buffer', 1000))
+    if config.get('stall_ms'):
+        StallDetector(config['stall_ms']).start()
+    profile = ProfileWindow(config.get('profile_seconds', 30), directory, name)
+
+    def dump():
+        TRACER.dump(os.path.join(directory, "{}-{}-{}.traces".format(name, os.getpid(), int(time.time()))))
+    signal.signal(signal.SIGUSR1, lambda signum, frame: reactor.callFromThread(dump))
+    signal.signal(signal.SIGUSR2, lambda signum, frame: reactor.callFromThread(profile.start))
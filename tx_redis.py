@@ -1,39 +1,178 @@
 from __future__ import print_function
 
-from twisted.internet import protocol
+import json
+import os
+import time
+from collections import deque
 
+from twisted.internet import defer, protocol, reactor
 
-class Node(object):
-    def __init__(self, length=None, parent=None, data=None):
-        self.data = data or []
-        self.parent = parent
-        self.length = length or (len(self.data) if isinstance(self.data, list) else None) or 1
+import metrics
+from tracing import TRACER
 
-    @property
-    def full(self):
-        if isinstance(self.data, list):
-            return len(self.data) >= self.length
-        else:
-            return bool(self.data)
 
-    def append(self, child):
-        if isinstance(child, Node):
-            child.parent = self
-        self.data.append(child)
+parse_seconds = metrics.histogram(
+    'mcrelay_redis_parse_seconds', 'Time spent parsing each chunk of data received from Redis.')
+connections = metrics.counter(
+    'mcrelay_redis_connections_total', 'Connections made to Redis, including reconnects.', ('role',))
+
+
+try:
+    import hiredis
+    ReplyError = hiredis.ReplyError
+except ImportError:
+    hiredis = None
+
+    class ReplyError(Exception):
+        pass
+
+
+class ProtocolError(Exception):
+    pass
+
+
+class NotConnected(Exception):
+    pass
 
-    def serialize(self):
-        if isinstance(self.data, list):
-            return [c.serialize() if isinstance(c, Node) else c for c in self.data]
-        else:
-            return self.data
+
+class Reader(object):
+    # Incremental RESP parser with the same feed()/gets() interface as
+    # hiredis.Reader. Data is appended to a bytearray and consumed by moving
+    # an offset forward instead of re-slicing the buffer for every token;
+    # partially received multi-bulks are kept as a stack of plain lists.
+
+    compact_threshold = 65536
+
+    def __init__(self):
+        self._buf = bytearray()
+        self._pos = 0
+        self._stack = []  # [list, items still missing] per open multi-bulk
+
+    def feed(self, data):
+        self._buf += data
+
+    def gets(self):
+        buf, pos, stack = self._buf, self._pos, self._stack
+        try:
+            while True:
+                end = buf.find('\r\n', pos)
+                if end < 0:
+                    return False
+                kind = buf[pos]
+                if kind == 36:  # '$'
+                    n = int(buf[pos + 1:end])
+                    if n < 0:
+                        value = None
+                        pos = end + 2
+                    else:
+                        start = end + 2
+                        if len(buf) < start + n + 2:
+                            return False
+                        value = str(buf[start:start + n])
+                        pos = start + n + 2
+                elif kind == 42:  # '*'
+                    n = int(buf[pos + 1:end])
+                    pos = end + 2
+                    if n > 0:
+                        stack.append([[], n])
+                        continue
+                    value = [] if n == 0 else None
+                elif kind == 58:  # ':'
+                    value = int(buf[pos + 1:end])
+                    pos = end + 2
+                elif kind == 43:  # '+'
+                    value = str(buf[pos + 1:end])
+                    pos = end + 2
+                elif kind == 45:  # '-'
+                    value = ReplyError(str(buf[pos + 1:end]))
+                    pos = end + 2
+                else:
+                    raise ProtocolError("bad reply type {!r}".format(chr(kind)))
+
+                while stack:
+                    top = stack[-1]
+                    top[0].append(value)
+                    top[1] -= 1
+                    if top[1]:
+                        break
+                    value = stack.pop()[0]
+                else:
+                    return value
+        finally:
+            self._pos = pos
+            if pos == len(buf):
+                del buf[:]
+                self._pos = 0
+            elif pos > self.compact_threshold:
+                del buf[:pos]
+                self._pos = 0
 
 
 class _RedisProtocol(protocol.Protocol):
+    # Commands are buffered and written once per reactor tick, so everything
+    # issued in the same tick goes out in a single write. Replies are matched
+    # to request() Deferreds in FIFO order; anything that arrives with no
+    # request waiting (pub/sub pushes) goes to the factory's handle().
+    _flush_call = None
+
+    def __init__(self, factory):
+        self.parent = factory
+        self.pending = deque()
+        self._outgoing = []
+
     def connectionMade(self):
         self.parent.connectionMade(self)
 
+    def connectionLost(self, reason):
+        if self._flush_call and self._flush_call.active():
+            self._flush_call.cancel()
+        self._flush_call = None
+        self._outgoing = []
+        self.parent.connectionLost(self, reason)
+        pending, self.pending = self.pending, deque()
+        for d in pending:
+            d.errback(reason)
+
+    def dataReceived(self, data):
+        start = time.time()
+        self.reader.feed(data)
+        replies = []
+        response = self.reader.gets()
+        while response is not False:
+            replies.append(response)
+            response = self.reader.gets()
+        parsed = time.time()
+        parse_seconds.observe(parsed - start)
+        TRACER.chunk(start, parsed)
+        for reply in replies:
+            self.replyReceived(reply)
+
+    def replyReceived(self, reply):
+        if self.pending:
+            d = self.pending.popleft()
+            if isinstance(reply, Exception):
+                d.errback(reply)
+            else:
+                d.callback(reply)
+        else:
+            self.parent.handle(reply)
+
+    def send(self, *args):
+        self._outgoing.append(self.encode_request(args))
+        if self._flush_call is None:
+            self._flush_call = reactor.callLater(0, self.flush)
+
     def request(self, *args):
-        self.transport.write(self.encode_request(args))
+        d = defer.Deferred()
+        self.pending.append(d)
+        self.send(*args)
+        return d
+
+    def flush(self):
+        self._flush_call = None
+        if self._outgoing:
+            data, self._outgoing = ''.join(self._outgoing), []
+            self.transport.write(data)
 
     def encode_request(self, args):
         lines = []
@@ -41,6 +180,8 @@ class _RedisProtocol(protocol.Protocol):
         for a in args:
             if isinstance(a, unicode):
                 a = a.encode('utf8')
+            elif not isinstance(a, str):
+                a = str(a)
             lines.append('$' + str(len(a)))
             lines.append(a)
         lines.append('')
@@ -49,140 +190,276 @@ class _RedisProtocol(protocol.Protocol):
 
 class HiRedisProtocol(_RedisProtocol):
     def __init__(self, factory):
-        self.parent = factory
+        _RedisProtocol.__init__(self, factory)
         self.reader = hiredis.Reader()
 
-    def dataReceived(self, data):
-        self.reader.feed(data)
-        response = self.reader.gets()
-        while response:
-            self.parent.handle(response)
-            response = self.reader.gets()
-
 
 class PythonRedisProtocol(_RedisProtocol):
-    decode_next = -1  # the number of bytes we require to decode the next thing
-                      # -1 is "until CRLF"
-    decode_state = 'type'
-    decode_type = '-'
-
-    buf = ''
-
     def __init__(self, factory):
-        self.parent = factory
-        self.decode_node = Node(length=1)
-
-    def reset(self):
-        self.decode_node = Node(length=1)
-
-    def add(self, thing):
-        while self.decode_node and self.decode_node.full:
-            assert self.decode_node != self.decode_node.parent
-            self.decode_node = self.decode_node.parent
-        assert self.decode_node
-        self.decode_node.append(thing)
-        if isinstance(thing, Node) and not thing.full:
-            self.decode_node = thing
-        else:
-            n = self.decode_node
-            while n.parent and n.full:
-                n = n.parent
-            if not n.parent:
-                d = n.data[0].serialize()
-                self.parent.handle(d)
-                self.reset()
-
-    def add_node(self, *a, **kw):
-        n = Node(*a, **kw)
-        self.add(n)
-        if not n.full:
-            self.decode_node = n
-
-    def decoder(self, data):
-        if self.decode_state == 'type':
-            self.decode_type = {
-                '$': 'bulk',
-                '*': 'multi_bulk',
-                ':': 'integer',
-                '+': 'status',
-                '-': 'error'
-            }.get(data[0])
-            stuff = data[1:]
-            if self.decode_type in ('status', 'error'):
-                self.reset()
-            else:
-                stuff = int(stuff)
-                if self.decode_type == 'bulk':
-                    if stuff == -1:
-                        self.add(None)
-                        self.decode_next = -1
-                        self.decode_state = 'type'
-                    else:
-                        self.decode_next = stuff + 2
-                        self.decode_state = 'read_bulk'
-                elif self.decode_type == 'multi_bulk':
-                    self.add_node(length=stuff)
-                    self.decode_next = -1
-                    self.decode_state = 'type'
-                elif self.decode_type == 'integer':
-                    self.add(stuff)
-                    self.decode_next = -1
-                    self.decode_state = 'type'
-        elif self.decode_state == 'read_bulk':
-            self.add(data)
-            self.decode_next = -1
-            self.decode_state = 'type'
-
-    def dataReceived(self, data):
-        self.buf += data
-        while True:
-            if self.decode_next >= 0 and len(self.buf) >= self.decode_next:
-                d = self.buf[:self.decode_next - 2]
-                self.buf = self.buf[self.decode_next:]
-                self.decoder(d)
-            elif self.decode_next < 0 and '\r\n' in self.buf:
-                d, self.buf = self.buf.split('\r\n', 1)
-                self.decoder(d)
-            else:
-                break
+        _RedisProtocol.__init__(self, factory)
+        self.reader = Reader()
 
 
-try:
-    import hiredis
+if hiredis is not None:
     RedisProtocol = HiRedisProtocol
     print("using hiredis to parse incoming redis messages")
-except ImportError:
+else:
     RedisProtocol = PythonRedisProtocol
-    print("using pure python to parse incoming redis messages - slow")
+    print("using pure python to parse incoming redis messages")
 
 
-class RedisFactory(protocol.ReconnectingClientFactory):
-    def __init__(self, parent, channels):
-        self.parent = parent
-        self.channels = channels
+class _RedisFactory(protocol.ReconnectingClientFactory):
+    protocol = None
 
     def buildProtocol(self, addr):
-        self.protocol = RedisProtocol(self)
-        return self.protocol
+        return RedisProtocol(self)
+
+    def connectionMade(self, protocol):
+        self.resetDelay()
+        self.protocol = protocol
+        connections.inc((self.__class__.__name__,))
+
+    def connectionLost(self, protocol, reason):
+        if self.protocol is protocol:
+            self.protocol = None
+
+
+class RedisFactory(_RedisFactory):
+    # Pub/sub connection. The channel and pattern sets are the live
+    # subscription state: they can be changed at any time and are replayed
+    # whenever the connection is (re)established. If `capture` is set to a
+    # capture.CaptureWriter, every message is also recorded there.
+    confirmations = ('subscribe', 'unsubscribe', 'psubscribe', 'punsubscribe')
+    capture = None
+
+    def __init__(self, parent, channels=(), patterns=()):
+        self.parent = parent
+        self.channels = set(channels)
+        self.patterns = set(patterns)
 
     def handle(self, thing):
         if isinstance(thing, list) and len(thing) >= 1:
             cmd, args = thing[0], thing[1:]
+            if cmd == 'message':
+                if args[0] not in self.channels:
+                    return
+                if self.capture:
+                    self.capture.write(time.time(), args[0], args[1])
+            elif cmd == 'pmessage':
+                if args[0] not in self.patterns:
+                    return
+                if self.capture:
+                    self.capture.write(time.time(), args[1], args[2])
             handler = getattr(self.parent, 'handle_' + cmd, None)
             if handler:
                 handler(*args)
-            else:
+            elif cmd not in self.confirmations:
                 print("warning: nothing handles '{}'".format(cmd))
         else:
             print("I don't understand: {}".format(repr(thing)))
 
     def connectionMade(self, protocol):
-        self.resetDelay()
-        self.subscribe(self.channels)
+        _RedisFactory.connectionMade(self, protocol)
+        if self.channels:
+            protocol.send("SUBSCRIBE", *self.channels)
+        if self.patterns:
+            protocol.send("PSUBSCRIBE", *self.patterns)
+
+    def subscribe(self, channels):
+        new = set(channels) - self.channels
+        self.channels |= new
+        if new and self.protocol:
+            self.protocol.send("SUBSCRIBE", *new)
+
+    def unsubscribe(self, channels):
+        gone = set(channels) & self.channels
+        self.channels -= gone
+        if gone and self.protocol:
+            self.protocol.send("UNSUBSCRIBE", *gone)
+
+    def psubscribe(self, patterns):
+        new = set(patterns) - self.patterns
+        self.patterns |= new
+        if new and self.protocol:
+            self.protocol.send("PSUBSCRIBE", *new)
+
+    def punsubscribe(self, patterns):
+        gone = set(patterns) & self.patterns
+        self.patterns -= gone
+        if gone and self.protocol:
+            self.protocol.send("PUNSUBSCRIBE", *gone)
 
-    def publish(self, data, channel=None):
-        channel = channel or self.channel
-        self.protocol.request("PUBLISH", channel, json.dumps(data))
+
+class RedisClientFactory(_RedisFactory):
+    # Command-mode connection: every call returns a Deferred that fires with
+    # the matching reply (or errbacks with ReplyError). With queue=True,
+    # commands issued while disconnected are held (up to max_queued, oldest
+    # dropped first) and sent when the connection comes back; commands that
+    # were already sent when the connection dropped fail with the reason.
+    max_queued = 10000
+
+    def __init__(self, parent=None, queue=False):
+        self.parent = parent
+        self.queued = deque() if queue else None
+
+    def handle(self, thing):
+        print("redis: unexpected reply: {}".format(repr(thing)))
+
+    def connectionMade(self, protocol):
+        _RedisFactory.connectionMade(self, protocol)
+        if self.queued:
+            queued, self.queued = self.queued, deque()
+            for args, d in queued:
+                protocol.request(*args).chainDeferred(d)
+
+    def request(self, *args):
+        if self.protocol is None:
+            if self.queued is None:
+                return defer.fail(NotConnected())
+            if len(self.queued) >= self.max_queued:
+                self.queued.popleft()[1].errback(NotConnected())
+            d = defer.Deferred()
+            self.queued.append((args, d))
+            return d
+        return self.protocol.request(*args)
+
+    def publish(self, channel, data):
+        return self.request("PUBLISH", channel, data)
+
+    def lpush(self, key, *values):
+        return self.request("LPUSH", key, *values)
+
+    def xadd(self, key, data, maxlen=None):
+        args = [key]
+        if maxlen:
+            args += ["MAXLEN", "~", maxlen]
+        return self.request("XADD", *(args + ["*", "data", data]))
+
+
+class RedisStreamFactory(_RedisFactory):
+    # Streams counterpart of RedisFactory. Each channel is a stream key read
+    # with XREAD BLOCK; entries are passed to the parent's handle_message
+    # just like pub/sub messages. The last ID seen per stream survives
+    # reconnects, and if state_file is set it is saved there so a restarted
+    # process resumes where it left off. Streams with no known ID start at
+    # start_id ('$' for new entries only, '0' for everything retained); '$'
+    # is turned into the stream's current last ID once, with XREVRANGE,
+    # so entries added between two XREADs aren't missed.
+    # Channels added with subscribe() are picked up by the next XREAD, i.e.
+    # within `block` milliseconds.
+    block = 5000
+    count = 1000
+    save_delay = 1.0
+    retry_delay = 5.0
+    capture = None
+
+    _save_call = None
+    _retry_call = None
+    _reading = False
+
+    def __init__(self, parent, channels=(), state_file=None, start_id='$'):
+        self.parent = parent
+        self.channels = set(channels)
+        self.state_file = state_file
+        self.start_id = start_id
+        self.last_ids = self.load_state()
+
+    def handle(self, thing):
+        print("redis: unexpected reply: {}".format(repr(thing)))
+
+    def connectionMade(self, protocol):
+        _RedisFactory.connectionMade(self, protocol)
+        self._reading = False
+        self.read()
 
     def subscribe(self, channels):
-        self.protocol.request("SUBSCRIBE", *channels)
+        self.channels |= set(channels)
+        if not self._reading and self._retry_call is None:
+            self.read()
+
+    def unsubscribe(self, channels):
+        self.channels -= set(channels)
+
+    def read(self):
+        if self._retry_call is not None:
+            if self._retry_call.active():
+                self._retry_call.cancel()
+            self._retry_call = None
+        if self.protocol is None or not self.channels:
+            self._reading = False
+            return
+        self._reading = True
+        protocol = self.protocol
+        keys = sorted(self.channels)
+        if self.start_id == '$':
+            new = [k for k in keys if k not in self.last_ids]
+            if new:
+                d = defer.gatherResults([protocol.request("XREVRANGE", k, "+", "-", "COUNT", 1) for k in new],
+                                        consumeErrors=True)
+                d.addCallbacks(self.got_last_ids, self.read_failed,
+                               callbackArgs=(protocol, new), errbackArgs=(protocol,))
+                return
+        ids = [self.last_ids.get(k, self.start_id) for k in keys]
+        d = protocol.request("XREAD", "COUNT", self.count, "BLOCK", self.block,
+                             "STREAMS", *(keys + ids))
+        d.addCallbacks(self.got_entries, self.read_failed,
+                       callbackArgs=(protocol,), errbackArgs=(protocol,))
+
+    def got_entries(self, reply, protocol):
+        if protocol is not self.protocol:
+            return
+        try:
+            for stream, entries in reply or ():
+                if stream not in self.channels:
+                    continue
+                for entry_id, fields in entries:
+                    self.last_ids[stream] = entry_id
+                    for i in xrange(0, len(fields) - 1, 2):
+                        if fields[i] == 'data':
+                            if self.capture:
+                                self.capture.write(time.time(), stream, fields[i + 1])
+                            self.parent.handle_message(stream, fields[i + 1])
+                            break
+            if reply:
+                self.save_state_later()
+        finally:
+            self.read()
+
+    def got_last_ids(self, replies, protocol, keys):
+        if protocol is not self.protocol:
+            return
+        for key, entries in zip(keys, replies):
+            self.last_ids.setdefault(key, entries[0][0] if entries else '0-0')
+        self.read()
+
+    def read_failed(self, failure, protocol):
+        if protocol is not self.protocol:
+            return
+        if isinstance(failure.value, defer.FirstError):
+            failure = failure.value.subFailure
+        print("redis: reading streams failed: {}".format(failure.getErrorMessage()))
+        self._reading = False
+        if self._retry_call is None:
+            self._retry_call = reactor.callLater(self.retry_delay, self.read)
+
+    def load_state(self):
+        if not self.state_file or not os.path.exists(self.state_file):
+            return {}
+        with open(self.state_file) as f:
+            return dict((k.encode('utf8'), v.encode('ascii')) for k, v in json.load(f).items())
+
+    def stopFactory(self):
+        if self._save_call is not None:
+            self._save_call.cancel()
+            self.save_state()
+
+    def save_state_later(self):
+        if self.state_file and self._save_call is None:
+            self._save_call = reactor.callLater(self.save_delay, self.save_state)
+
+    def save_state(self):
+        self._save_call = None
+        tmp = self.state_file + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.last_ids, f)
+        os.rename(tmp, self.state_file)
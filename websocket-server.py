@@ -1,71 +1,420 @@
 #!/usr/bin/python
+import bisect
+import errno
 import json
+import mmap
+import os
+import re
+import socket
 import sys
 import string
 import random
+import signal
+import struct
 import time
+import urlparse
 import yaml
+from collections import deque
 
-from tx_redis import RedisFactory
+import metrics
+import tracing
+from capture import CaptureWriter
+from tracing import TRACER
+from tx_redis import RedisFactory, RedisStreamFactory
 
+from twisted.internet import defer
 from twisted.internet import protocol
 from twisted.internet import reactor
+from twisted.internet import task
 from twisted.python import log
 from twisted.application.strports import listen
 
-from txws import WebSocketFactory
+from txws import WebSocketFactory, FRAMES, HYBI00, HYBI07, HYBI10, RFC6455
+from txws import encoders, make_hybi00_frame, make_hybi07_frame
 
 
 ALPHABET = string.lowercase + string.uppercase + string.digits
 
+# fd on which supervised workers inherit the shared listening socket
+WORKER_FD = 3
 
-with open("config.yml") as f:
-    CONFIG = yaml.load(f)
 
+CONFIG = None
 
-class RelayHistory(object):
-    _counter = 0
+messages_received = metrics.counter(
+    'mcrelay_messages_received_total', 'Messages received from Redis.', ('channel',))
+fanout_seconds = metrics.histogram(
+    'mcrelay_fanout_seconds', 'Time taken to relay one message to every client of its channel.', ('channel',))
+history_replays = metrics.counter(
+    'mcrelay_history_replays_total', 'History sent to new clients: all of it to plain clients (plain), '
+    'or to numbered clients all of it (full) or only what they missed (delta).', ('kind',))
+
+
+def load_config(path="config.yml"):
+    with open(path) as f:
+        return yaml.load(f)
+
+
+def new_epoch():
+    return os.urandom(6).encode('hex')
+
+
+def numbered(seq, event):
+    return "{} {}".format(seq, event)
+
+
+_codec_framers = {}
 
-    def __init__(self, size, mode='count'):
+
+def codec_framer(framer, codec):
+    # one function per (framer, codec), so relay() can share its frames
+    key = (framer, codec)
+    if key not in _codec_framers:
+        encode = encoders[codec]
+        _codec_framers[key] = lambda data: framer(encode(data))
+    return _codec_framers[key]
+
+
+def parse_since(value):
+    # "<epoch>:<seq>" -> (epoch, seq), anything else -> None
+    epoch, _, seq = value.strip().partition(':')
+    if epoch and seq.isdigit():
+        return epoch, int(seq)
+    return None
+
+
+class RelayHistory(object):
+    # Entries are kept in parallel lists of timestamps and events. Evicting
+    # only moves _start forward; the dead prefix is cut off once it is half
+    # of the list, so pushes and evictions are amortised O(1), and the time
+    # limit can bisect the (sorted) timestamps. Entries are addressed by
+    # sequence number (_base is the sequence number of index 0), which lets
+    # iterators walk the live lists without copying them and without being
+    # confused by pushes or evictions in between. Sequence numbers only
+    # mean something together with the epoch, which is new for every
+    # history, so a client can't resume into a restarted server's history.
+    compact_min = 32
+
+    def __init__(self, size, mode='count', max_bytes=None):
         self._size = size
         self._mode = mode
-        self._hardlimit = self._size * 3
-        self._history = []
+        self._max_bytes = max_bytes
+        self._times = []
+        self._events = []
+        self._start = 0
+        self._base = 0
+        self._snapshots = {}
+        self.bytes = 0
+        self.epoch = new_epoch()
+
+    def __len__(self):
+        return len(self._events) - self._start
+
+    @property
+    def first_seq(self):
+        return self._base + self._start
+
+    @property
+    def next_seq(self):
+        return self._base + len(self._events)
 
     def push(self, event):
-        event = (time.time(), event)
-        self._history.append(event)
+        now = time.time()
+        seq = self.next_seq
+        self._snapshots.clear()
+        self._times.append(now)
+        self._events.append(event)
+        self.bytes += len(event)
         if self._mode == 'count':
-            self._limiter_count(event)
+            self._evict(len(self._events) - self._size)
         else:
-            self._limiter_time(event)
+            self._expire(now)
+        if self._max_bytes:
+            while self.bytes > self._max_bytes and len(self):
+                self._evict(self._start + 1)
+        return seq
+
+    def _expire(self, now):
+        self._evict(bisect.bisect_left(self._times, now - self._size, self._start))
+
+    def _evict(self, end):
+        events = self._events
+        for i in xrange(self._start, end):
+            self.bytes -= len(events[i])
+            events[i] = None
+        if end <= self._start:
+            return
+        self._snapshots.clear()
+        self._start = end
+        if end >= self.compact_min and end * 2 >= len(events):
+            del events[:end]
+            del self._times[:end]
+            self._base += end
+            self._start = 0
 
-    def _limiter_count(self, event):
-        self._counter += 1
-        while self._counter > self._size or len(self._history) > self._hardlimit:
-            ev = self._history.pop(0)
-            self._counter -= 1
+    def __iter__(self):
+        if self._mode != 'count':
+            self._expire(time.time())
+        return self._iter(self._base + self._start, self._base + len(self._events))
+
+    def since(self, seq):
+        # [(sequence number, event)] for the entries from seq on
+        if self._mode != 'count':
+            self._expire(time.time())
+        events, base = self._events, self._base
+        return [(s, events[s - base]) for s in xrange(max(seq, self.first_seq), self.next_seq)]
+
+    def snapshot(self, framer, number=False):
+        # The whole history as one string of ready-made WebSocket frames,
+        # with sequence numbers if `number`. It is built at most once per
+        # framer between pushes, so a burst of joining clients shares a
+        # single copy.
+        if self._mode != 'count':
+            self._expire(time.time())
+        blob = self._snapshots.get((framer, number))
+        if blob is None:
+            if number:
+                blob = ''.join(framer(numbered(s, ev)) for s, ev in self.since(0))
+            else:
+                blob = ''.join(framer(ev) for ev in self)
+            self._snapshots[(framer, number)] = blob
+        return blob
+
+    def _iter(self, seq, end):
+        while seq < end:
+            i = seq - self._base
+            if i < self._start:
+                i = self._start
+                seq = self._base + i
+                if seq >= end:
+                    return
+            yield self._events[i]
+            seq += 1
+
+    def close(self):
+        pass
 
-    def _limiter_time(self, event):
-        n = 0
-        while self._history[n][0] < time.time() - self._size:
-            n += 1
-        del self._history[:n]
+
+class MappedHistory(object):
+    # RelayHistory kept in a fixed-size memory-mapped ring file instead of
+    # on the heap, so it survives restarts. The header holds the offsets of
+    # the oldest record (head) and the write position (tail), the record
+    # count, the next sequence number and the epoch (so clients can resume
+    # across a restart); records are a RECORD header (payload length,
+    # sequence number, time) and the payload. A record that doesn't fit
+    # before the end of the ring goes to the start, after a WRAP marker.
+    # The header never points at bytes that are being written: records
+    # that have to make room for a new one are evicted in the header
+    # first, and the new record is only added to it once it is written. So
+    # if the process dies, the file holds every record up to the last
+    # complete push, and opening it only reads the header. (Nothing is
+    # synced to disk, so an OS crash or power loss can lose more.) `size`
+    # and `mode` limit the history like RelayHistory's; the file's
+    # capacity limits its bytes.
+    HEADER = struct.Struct('<8sQQQQQQQ')
+    RECORD = struct.Struct('<IQd')
+    MAGIC = 'MCRHIST2'
+    WRAP = 0xFFFFFFFF
+
+    def __init__(self, path, capacity, size, mode='count'):
+        self._size = size
+        self._mode = mode
+        self._snapshots = {}
+        self.capacity = capacity
+        total = self.HEADER.size + capacity
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0644)
+        try:
+            fresh = os.fstat(fd).st_size != total
+            if fresh:
+                os.ftruncate(fd, total)
+            self._map = mmap.mmap(fd, total)
+        finally:
+            os.close(fd)
+        magic, cap, self._head, self._tail, self._count, self._next, self.bytes, epoch = \
+            self.HEADER.unpack_from(self._map, 0)
+        if fresh or magic != self.MAGIC or cap != capacity:
+            if not fresh:
+                log.msg("history file {} is unusable, starting empty".format(path))
+            self._head = self._tail = self._count = self._next = self.bytes = 0
+            self._epoch = int(new_epoch(), 16)
+            self._save()
+        else:
+            self._epoch = epoch
+        self.epoch = '{:012x}'.format(self._epoch)
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def first_seq(self):
+        if not self._count:
+            return self._next
+        pos = self._record_at(self._head)
+        return self.RECORD.unpack_from(self._map, self.HEADER.size + pos)[1]
+
+    @property
+    def next_seq(self):
+        return self._next
+
+    def _save(self):
+        self.HEADER.pack_into(self._map, 0, self.MAGIC, self.capacity, self._head, self._tail,
+                              self._count, self._next, self.bytes, self._epoch)
+
+    def _record_at(self, pos):
+        # follows a WRAP marker (or the few bytes too short to hold one)
+        if self.capacity - pos < 4:
+            return 0
+        if struct.unpack_from('<I', self._map, self.HEADER.size + pos)[0] == self.WRAP:
+            return 0
+        return pos
+
+    def _evict_oldest(self):
+        pos = self._record_at(self._head)
+        length = self.RECORD.unpack_from(self._map, self.HEADER.size + pos)[0]
+        self._count -= 1
+        self.bytes -= length
+        if self._count:
+            self._head = self._record_at(pos + self.RECORD.size + length)
+        else:
+            self._head = self._tail = 0
+        self._snapshots.clear()
+
+    def push(self, event):
+        seq = self._next
+        need = self.RECORD.size + len(event)
+        if need > self.capacity:
+            # like RelayHistory going over max_bytes: nothing is left
+            while self._count:
+                self._evict_oldest()
+            self._next += 1
+            self._save()
+            return seq
+        now = time.time()
+        moved = False
+        while self._count:
+            if self._tail > self._head:
+                if self.capacity - self._tail >= need:
+                    break
+                if self._head >= need:
+                    if self.capacity - self._tail >= 4:
+                        struct.pack_into('<I', self._map, self.HEADER.size + self._tail, self.WRAP)
+                    self._tail = 0
+                    moved = True
+                    break
+            elif self._head - self._tail >= need:
+                break
+            self._evict_oldest()
+            moved = True
+        if moved:
+            self._save()
+        offset = self.HEADER.size + self._tail
+        self.RECORD.pack_into(self._map, offset, len(event), seq, now)
+        self._map[offset + self.RECORD.size:offset + need] = event
+        self._tail += need
+        self._count += 1
+        self._next += 1
+        self.bytes += len(event)
+        self._snapshots.clear()
+        if self._mode == 'count':
+            while self._count > self._size:
+                self._evict_oldest()
+        else:
+            self._expire(now)
+        self._save()
+        return seq
+
+    def _expire(self, now):
+        # evicts what is too old; the caller saves the header if this is true
+        expired = False
+        while self._count:
+            pos = self._record_at(self._head)
+            if self.RECORD.unpack_from(self._map, self.HEADER.size + pos)[2] >= now - self._size:
+                break
+            self._evict_oldest()
+            expired = True
+        return expired
 
     def __iter__(self):
-        for ev in list(self._history):
-            yield ev[1]
+        return iter([ev for _, ev in self.since(0)])
+
+    def since(self, seq):
+        if self._mode != 'count' and self._expire(time.time()):
+            self._save()
+        entries = []
+        pos = self._head
+        for i in xrange(self._count):
+            pos = self._record_at(pos)
+            start = self.HEADER.size + pos + self.RECORD.size
+            length, s, _ = self.RECORD.unpack_from(self._map, start - self.RECORD.size)
+            if s >= seq:
+                entries.append((s, self._map[start:start + length]))
+            pos += self.RECORD.size + length
+        return entries
+
+    def snapshot(self, framer, number=False):
+        if self._mode != 'count' and self._expire(time.time()):
+            self._save()
+        blob = self._snapshots.get((framer, number))
+        if blob is None:
+            if number:
+                blob = ''.join(framer(numbered(s, ev)) for s, ev in self.since(0))
+            else:
+                blob = ''.join(framer(ev) for ev in self)
+            self._snapshots[(framer, number)] = blob
+        return blob
+
+    def close(self):
+        self._map.close()
 
 
 class WebProtocol(protocol.Protocol):
+    _framer = None
+    channel = None
+    paused = False
+    closing = False
+    replaying = False
+    numbered = False
+    since = None
+    since_timeout = 2.0
+    _since_call = None
+    handshake_bytes = 0
+
     def __init__(self, factory):
         self.factory = factory
+        self.backlog = deque()
+        self.backlog_bytes = 0
+        self.slow = set()
 
     def get_channel(self):
-        bits = self.transport.location.split('/')
+        # /chat/<channel>/socket[?since=...]. A since parameter asks for
+        # numbered messages (see ReplayScheduler): `<epoch>:<seq>` is the
+        # last message the client saw, `frame` means that is sent as the
+        # first frame instead, and an empty value means nothing to resume.
+        path, _, query = self.transport.location.partition('?')
+        bits = path.split('/')
         assert bits[0] == '' and bits[1] == 'chat' and bits[3] == 'socket'
+        since = urlparse.parse_qs(query, keep_blank_values=True).get('since')
+        if since is not None:
+            self.numbered = True
+            self.since = parse_since(since[0])
+            if since[0] == 'frame':
+                self._since_call = reactor.callLater(self.since_timeout, self.got_since, '')
         return bits[2]
 
+    def waiting_for_since(self):
+        return self._since_call is not None
+
+    def got_since(self, value):
+        self._since_call = None
+        self.since = parse_since(value)
+        self.factory.parent.new_client(self)
+
+    def dataReceived(self, data):
+        # clients are only listened to for their first-frame position
+        if self._since_call is not None:
+            self._since_call.cancel()
+            self.got_since(data)
+
     def connectionMade(self):
         oldValidateHeaders = self.transport.validateHeaders
         def wrap(*args, **kwargs):
@@ -75,22 +424,106 @@ class WebProtocol(protocol.Protocol):
         self.transport.validateHeaders = wrap
 
     def headersValidated(self):
+        # Register as a streaming producer so the TCP transport tells us when
+        # its send buffer is full; while paused, frames are held in our own
+        # bounded backlog instead of piling up in Twisted's buffer.
+        self.transport.registerProducer(self, True)
         self.factory.connectionMade(self)
 
     def connectionLost(self, reason):
+        self.closing = True
+        if self._since_call is not None:
+            self._since_call.cancel()
+            self._since_call = None
         self.factory.connectionLost(self)
 
     def send(self, data):
+        # Once the handshake is done this goes through write_frames() and
+        # its backlog like fan-out does. Until then txws holds the data
+        # itself, without a limit, so a client that doesn't finish its
+        # handshake is dropped once that is over max_backlog.
         if isinstance(data, unicode):
             data = data.encode('utf8')
+        framer = self.framer()
+        if framer is not None:
+            self.write_frames(framer(data))
+            return
+        self.handshake_bytes += len(data)
+        if self.handshake_bytes > self.factory.max_backlog:
+            if not self.closing:
+                log.msg("disconnecting client stuck in its handshake {}".format(self.transport.getPeer()))
+                self.closing = True
+                self.transport.transport.abortConnection()
+            return
         self.transport.write(data)
 
+    def framer(self):
+        # The frame builder for this connection, if frames we build
+        # ourselves can go straight to the socket; None until the handshake
+        # is finished.
+        if self._framer is not None:
+            return self._framer
+        ws = self.transport
+        if ws.state != FRAMES:
+            return None
+        if ws.flavor in (HYBI07, HYBI10, RFC6455):
+            framer = make_hybi07_frame
+        elif ws.flavor == HYBI00:
+            framer = make_hybi00_frame
+        else:
+            return None
+        if ws.codec:
+            framer = codec_framer(framer, ws.codec)
+        self._framer = framer
+        return framer
+
+    def write_frames(self, frames):
+        if self.paused or self.replaying:
+            if self.closing:
+                return
+            self.backlog.append(frames)
+            self.backlog_bytes += len(frames)
+            if self.backlog_bytes > self.factory.max_backlog:
+                self.factory.slow_client(self)
+        else:
+            self.transport.transport.write(frames)
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        self.flush_backlog()
+
+    def finish_replay(self):
+        self.replaying = False
+        if not self.paused:
+            self.flush_backlog()
+
+    def flush_backlog(self):
+        if self.backlog and not self.replaying:
+            data = ''.join(self.backlog)
+            self.backlog.clear()
+            self.backlog_bytes = 0
+            self.transport.transport.write(data)
+
+    def stopProducing(self):
+        self.backlog.clear()
+        self.backlog_bytes = 0
+
 
 class WebFactory(protocol.ServerFactory):
-    def __init__(self, parent, channels):
+    slow_policies = ('drop_oldest', 'latest', 'disconnect')
+
+    def __init__(self, parent, channels, max_backlog=1048576, slow_policy='drop_oldest'):
+        if slow_policy not in self.slow_policies:
+            raise ValueError("unknown slow client policy: {}".format(slow_policy))
         self.parent = parent
         self.channel_map = channels
         self.clients = {v: set() for v in self.channel_map.values()}
+        self.max_backlog = max_backlog
+        self.slow_policy = slow_policy
+        self.slow_clients = dict((k, 0) for k in self.slow_policies)
 
     def buildProtocol(self, addr):
         return WebProtocol(self)
@@ -100,39 +533,290 @@ class WebFactory(protocol.ServerFactory):
         if channel not in self.channel_map:
             self.parent.error_client(protocol, "{} is not a valid channel!".format(channel))
         else:
-            self.parent.new_client(protocol)
-            ch = self.channel_map[channel]
-            self.clients[ch].add(protocol)
+            protocol.channel = self.channel_map[channel]
+            if not protocol.waiting_for_since():
+                self.parent.new_client(protocol)
 
-    def connectionLost(self, protocol):
-        if protocol.get_channel() not in self.clients or protocol not in self.clients[protocol.get_channel()]:
-            return
-        self.clients[protocol.get_channel()].remove(protocol)
+    def add_client(self, protocol):
+        self.clients[protocol.channel].add(protocol)
 
-    def relay(self, channel, data):
+    def set_channels(self, channels):
+        # Returns the clients of redis channels that are no longer mapped.
+        self.channel_map = channels
+        gone = []
+        for channel in set(self.clients) - set(channels.values()):
+            gone.extend(self.clients.pop(channel))
+        for channel in channels.values():
+            self.clients.setdefault(channel, set())
+        return gone
+
+    def connectionLost(self, protocol):
+        if protocol.channel in self.clients:
+            self.clients[protocol.channel].discard(protocol)
+
+    def slow_client(self, protocol):
+        # Called when a paused client's backlog goes over max_backlog.
+        # slow_clients counts each client once per policy applied to it.
+        policy = self.slow_policy
+        if policy not in protocol.slow:
+            protocol.slow.add(policy)
+            self.slow_clients[policy] += 1
+        if policy == 'disconnect':
+            log.msg("disconnecting slow client {}".format(protocol.transport.getPeer()))
+            protocol.closing = True
+            protocol.stopProducing()
+            protocol.transport.transport.abortConnection()
+        elif policy == 'latest':
+            latest = protocol.backlog.pop()
+            protocol.backlog.clear()
+            protocol.backlog.append(latest)
+            protocol.backlog_bytes = len(latest)
+        else:
+            while protocol.backlog_bytes > self.max_backlog:
+                protocol.backlog_bytes -= len(protocol.backlog.popleft())
+
+    def relay(self, channel, data, seq=None):
+        # Build each kind of frame once per message and hand the same string
+        # to every client, instead of having txws re-frame it per client.
+        # Numbered clients get "<seq> <data>" frames, keyed (framer, True).
+        start = time.time()
+        if isinstance(data, unicode):
+            data = data.encode('utf8')
+        frames = {}
         for p in self.clients[channel]:
-            p.send(data)
+            framer = p.framer()
+            key = (framer, True) if p.numbered else framer
+            frame = frames.get(key)
+            if frame is None:
+                message = numbered(seq, data) if p.numbered else data
+                if framer is None:
+                    p.send(message)
+                    continue
+                frame = frames[key] = framer(message)
+            p.write_frames(frame)
+        fanout_seconds.observe(time.time() - start, (channel,))
+
+
+class ReplayScheduler(object):
+    # Sends history to new clients from a cooperative task, so a reconnect
+    # storm can't hold up the reactor. Clients queue until one of
+    # max_active replay slots is free; on admission they get the current
+    # snapshot and start receiving live messages, which are held in their
+    # backlog until the snapshot has been written. All active replays
+    # together write at most bytes_per_tick per reactor iteration, then the
+    # task yields so live fan-out always goes first.
+    #
+    # Numbered clients first get "@epoch <epoch> full|delta". If their
+    # `since` position is in this history's epoch and no older than its
+    # oldest entry, "delta" is followed by just the entries after it;
+    # otherwise "full" by the whole history, and the client should forget
+    # what it had.
+    idle_delay = 0.05
+
+    def __init__(self, factory, max_active=50, bytes_per_tick=262144, chunk_size=16384):
+        self.factory = factory
+        self.max_active = max_active
+        self.bytes_per_tick = bytes_per_tick
+        self.chunk_size = chunk_size
+        self.waiting = deque()
+        self.active = deque()
+        self._task = None
+
+    def add(self, client, history):
+        self.waiting.append((client, history))
+        if self._task is None:
+            self._task = task.cooperate(self._run())
+            self._task.whenDone().addBoth(self._finished)
+
+    def _finished(self, result):
+        self._task = None
+
+    def _admit(self, client, history):
+        if client.closing:
+            return
+        self.factory.add_client(client)
+        framer = client.framer()
+        if not client.numbered:
+            history_replays.inc(('plain',))
+            if framer is None:
+                for msg in history:
+                    client.send(msg)
+                return
+            data = history.snapshot(framer)
+        else:
+            since = client.since
+            if since and since[0] == history.epoch and history.first_seq - 1 <= since[1] < history.next_seq:
+                kind, entries = 'delta', history.since(since[1] + 1)
+            else:
+                kind, entries = 'full', None
+            history_replays.inc((kind,))
+            hello = "@epoch {} {}".format(history.epoch, kind)
+            if framer is None:
+                client.send(hello)
+                for seq, msg in history.since(0) if entries is None else entries:
+                    client.send(numbered(seq, msg))
+                return
+            if entries is None:
+                data = framer(hello) + history.snapshot(framer, True)
+            else:
+                data = framer(hello) + ''.join(framer(numbered(s, msg)) for s, msg in entries)
+        client.replaying = True
+        self.active.append([client, data, 0])
+
+    def _step(self, replay):
+        client, data, offset = replay
+        if client.closing:
+            return 0
+        if client.paused:
+            self.active.append(replay)
+            return 0
+        chunk = data[offset:offset + self.chunk_size]
+        if chunk:
+            client.transport.transport.write(chunk)
+        replay[2] = offset + len(chunk)
+        if replay[2] < len(data):
+            self.active.append(replay)
+        else:
+            client.finish_replay()
+        return len(chunk)
+
+    def _run(self):
+        while self.waiting or self.active:
+            budget = self.bytes_per_tick
+            idle = 0
+            while budget > 0:
+                while self.waiting and len(self.active) < self.max_active:
+                    self._admit(*self.waiting.popleft())
+                if not self.active or idle >= len(self.active):
+                    break
+                written = self._step(self.active.popleft())
+                budget -= written
+                idle = 0 if written else idle + 1
+            delay = self.idle_delay if budget == self.bytes_per_tick else 0
+            yield task.deferLater(reactor, delay, lambda: None)
 
 
 class Manager:
-    def setup(self):
+    def setup(self, listen_fd=None, worker=None):
         self.channel_map = CONFIG['web']['channel_map']
-        self.history = dict((k, RelayHistory(CONFIG['web']['history_size'], CONFIG['web']['history_mode'])) for k in self.channel_map.values())
-
-        self.redis_factory = RedisFactory(self, list(v for v in self.channel_map.values()))
-        self._web_factory = WebFactory(self, self.channel_map)
+        self.worker = worker
+        self.history = dict((k, self.make_history(k)) for k in self.channel_map.values())
+
+        if CONFIG.get('redis_mode') == 'streams':
+            streams = CONFIG.get('streams', {})
+            state = streams.get('web_state')
+            if state and worker is not None:
+                state = "{}.{}".format(state, worker)
+            self.redis_factory = RedisStreamFactory(self, self.channel_map.values(), state, start_id='0')
+        else:
+            self.redis_factory = RedisFactory(self, self.channel_map.values())
+        self._web_factory = WebFactory(self, self.channel_map,
+                                       CONFIG['web'].get('max_backlog', 1048576),
+                                       CONFIG['web'].get('slow_policy', 'drop_oldest'))
         self.ws_factory = WebSocketFactory(self._web_factory)
-
+        self.replays = ReplayScheduler(self._web_factory,
+                                       CONFIG['web'].get('replay_concurrency', 50),
+                                       CONFIG['web'].get('replay_bytes_per_tick', 262144))
+
+        capture = CONFIG.get('capture', {}).get('web')
+        if capture:
+            if worker is not None:
+                capture = "{}.{}".format(capture, worker)
+            self.redis_factory.capture = CaptureWriter(capture)
+            reactor.addSystemEventTrigger("before", "shutdown", self.redis_factory.capture.close)
         reactor.connectTCP(CONFIG['redis_host'], CONFIG['redis_port'], self.redis_factory)
-        listen(CONFIG['web']['host'], self.ws_factory)
+
+        self.register_metrics()
+        if CONFIG.get('metrics', {}).get('web'):
+            metrics.listen(CONFIG['metrics']['web'], worker or 0)
+        if listen_fd is None:
+            listen(CONFIG['web']['host'], self.ws_factory)
+        else:
+            reactor.adoptStreamPort(listen_fd, socket.AF_INET, self.ws_factory)
+
+    def register_metrics(self):
+        factory = self._web_factory
+        metrics.callback('mcrelay_clients', 'Connected WebSocket clients.',
+                         lambda: dict(((k,), len(v)) for k, v in factory.clients.items()), ('channel',))
+        metrics.callback('mcrelay_history_bytes', 'Bytes of history kept.',
+                         lambda: dict(((k,), h.bytes) for k, h in self.history.items()), ('channel',))
+        metrics.callback('mcrelay_history_messages', 'Messages of history kept.',
+                         lambda: dict(((k,), len(h)) for k, h in self.history.items()), ('channel',))
+        metrics.callback('mcrelay_slow_clients_total', 'Slow clients, by the policy applied to them.',
+                         lambda: dict(((k,), v) for k, v in factory.slow_clients.items()), ('policy',),
+                         kind='counter')
+        metrics.callback('mcrelay_replays', 'History replays in progress or waiting for a slot.',
+                         lambda: {('active',): len(self.replays.active), ('waiting',): len(self.replays.waiting)},
+                         ('state',))
+
+    def make_history(self, channel):
+        web = CONFIG['web']
+        if web.get('history_dir'):
+            name = re.sub(r'[^A-Za-z0-9._-]', '_', channel)
+            if self.worker is not None:
+                name = "{}.{}".format(name, self.worker)
+            try:
+                os.makedirs(web['history_dir'])
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            path = os.path.join(web['history_dir'], name + '.history')
+            return MappedHistory(path, web.get('history_bytes') or 1048576, web['history_size'], web['history_mode'])
+        return RelayHistory(web['history_size'], web['history_mode'], web.get('history_bytes'))
+
+    def reload(self):
+        # SIGHUP: re-read config.yml and apply the channel_map difference.
+        # New redis channels get a history and a subscription; clients of
+        # channels that went away are disconnected and their histories
+        # dropped. Other clients stay connected. max_backlog and slow_policy
+        # are applied as well; anything else needs a restart.
+        global CONFIG
+        try:
+            config = load_config()
+            web = config['web']
+            slow_policy = web.get('slow_policy', 'drop_oldest')
+            if slow_policy not in WebFactory.slow_policies:
+                raise ValueError("unknown slow client policy: {}".format(slow_policy))
+        except Exception as e:
+            log.msg("config reload failed: {}".format(e))
+            return
+        CONFIG = config
+
+        old = set(self.channel_map.values())
+        self.channel_map = web['channel_map']
+        new = set(self.channel_map.values())
+        for channel in new - old:
+            self.history[channel] = self.make_history(channel)
+        gone = self._web_factory.set_channels(self.channel_map)
+        gone.extend(c for c, h in self.replays.waiting if c.channel in old - new)
+        for client in gone:
+            client.closing = True
+            self.error_client(client, "This channel has been closed.")
+        for channel in old - new:
+            self.history.pop(channel).close()
+        self.redis_factory.unsubscribe(old - new)
+        self.redis_factory.subscribe(new - old)
+
+        self._web_factory.max_backlog = web.get('max_backlog', 1048576)
+        self._web_factory.slow_policy = slow_policy
+        log.msg("config reloaded: {} channels (+{} -{}), {} clients disconnected".format(
+            len(new), len(new - old), len(old - new), len(gone)))
 
     @staticmethod
     def random_str(l=12):
         return ''.join(random.choice(ALPHABET) for i in xrange(l))
 
     def new_client(self, client):
-        for msg in self.history.get(self.channel_map[client.get_channel()], []):
-            client.send(msg)
+        # numbered clients always go through the scheduler for their
+        # "@epoch" frame; the channel may have gone while one was sending
+        # its first-frame position
+        history = self.history.get(client.channel)
+        if history is None:
+            self.error_client(client, "This channel has been closed.")
+        elif history or client.numbered:
+            self.replays.add(client, history)
+        else:
+            self._web_factory.add_client(client)
 
     def error_client(self, client, message):
         client.send(u"\u00a7e" + message)
@@ -142,12 +826,126 @@ class Manager:
         pass
 
     def handle_message(self, channel, data):
-        self.history[channel].push(data)
-        self._web_factory.relay(channel, data)
+        messages_received.inc((channel,))
+        if channel not in self.history:
+            return
+        trace = TRACER.start(channel)
+        seq = self.history[channel].push(data)
+        TRACER.mark(trace, 'history')
+        self._web_factory.relay(channel, data, seq)
+        TRACER.mark(trace, 'fanout')
+        TRACER.finish(trace)
+
+    def handle_pmessage(self, pattern, channel, data):
+        self.handle_message(channel, data)
+
+
+def listen_socket(description, backlog=50):
+    # Supervisor mode binds the socket itself so it can be handed to the
+    # workers; only "tcp:PORT[:interface=ADDR][:backlog=N]" is supported.
+    parts = description.split(':')
+    if parts[0] != 'tcp' or len(parts) < 2:
+        raise ValueError("workers need a tcp listen address, not {}".format(description))
+    options = dict(p.split('=', 1) for p in parts[2:])
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    s.bind((options.get('interface', ''), int(parts[1])))
+    s.listen(int(options.get('backlog', backlog)))
+    s.setblocking(False)
+    return s
+
+
+class WorkerProcess(protocol.ProcessProtocol):
+    def __init__(self, supervisor, index):
+        self.supervisor = supervisor
+        self.index = index
+
+    def processEnded(self, reason):
+        self.supervisor.worker_ended(self, reason)
+
+
+class Supervisor(object):
+    # Runs `count` copies of this script as workers. They all accept() on
+    # one listening socket, inherited as WORKER_FD, and each has its own
+    # Redis subscription, history and WebFactory. Workers that die are
+    # restarted; on shutdown they are sent SIGTERM and waited for.
+    restart_delay = 1.0
+
+    def __init__(self, count):
+        self.count = count
+        self.workers = {}
+        self.stopping = False
+        self._stopped = None
+
+    def start(self):
+        self.socket = listen_socket(CONFIG['web']['host'])
+        for i in xrange(self.count):
+            self.spawn(i)
+        reactor.addSystemEventTrigger("before", "shutdown", self.stop)
+
+    def spawn(self, index):
+        if self.stopping:
+            return
+        worker = self.workers[index] = WorkerProcess(self, index)
+        args = [sys.executable, os.path.abspath(__file__), '--worker', str(index)]
+        reactor.spawnProcess(worker, sys.executable, args, env=os.environ,
+                             childFDs={0: 0, 1: 1, 2: 2, WORKER_FD: self.socket.fileno()})
+
+    def worker_ended(self, worker, reason):
+        if self.workers.get(worker.index) is worker:
+            del self.workers[worker.index]
+        if self.stopping:
+            if not self.workers and self._stopped:
+                self._stopped.callback(None)
+        else:
+            log.msg("worker {} exited ({}), restarting".format(worker.index, reason.getErrorMessage()))
+            reactor.callLater(self.restart_delay, self.spawn, worker.index)
+
+    def signal_workers(self, signum):
+        for worker in self.workers.values():
+            worker.transport.signalProcess(signum)
+
+    def reload(self):
+        self.signal_workers('HUP')
+
+    def stop(self):
+        self.stopping = True
+        if not self.workers:
+            return
+        self._stopped = defer.Deferred()
+        for worker in self.workers.values():
+            worker.transport.signalProcess('TERM')
+        return self._stopped
+
+
+def watch_parent():
+    # Workers exit if the supervisor goes away without stopping them.
+    ppid = os.getppid()
+    def check():
+        if os.getppid() != ppid:
+            log.msg("supervisor is gone, exiting")
+            reactor.stop()
+    task.LoopingCall(check).start(1.0, now=False)
 
 
 if __name__ == '__main__':
+    CONFIG = load_config()
     log.startLogging(sys.stdout)
-    manager = Manager()
-    manager.setup()
+    if len(sys.argv) > 2 and sys.argv[1] == '--worker':
+        manager = Manager()
+        manager.setup(WORKER_FD, int(sys.argv[2]))
+        tracing.setup(CONFIG.get('tracing', {}), 'websocket-{}'.format(sys.argv[2]))
+        watch_parent()
+    elif CONFIG['web'].get('workers', 1) > 1:
+        # workers reload and trace themselves; the supervisor only passes
+        # SIGHUP, SIGUSR1 and SIGUSR2 on
+        manager = Supervisor(CONFIG['web']['workers'])
+        manager.start()
+        for signum in (signal.SIGUSR1, signal.SIGUSR2):
+            signal.signal(signum, lambda signum, frame: reactor.callFromThread(manager.signal_workers, signum))
+    else:
+        manager = Manager()
+        manager.setup()
+        tracing.setup(CONFIG.get('tracing', {}), 'websocket')
+    signal.signal(signal.SIGHUP, lambda signum, frame: reactor.callFromThread(manager.reload))
     reactor.run()
\ No newline at end of file